@@ -3,154 +3,68 @@ Módulo de Envío de Correos para Sistema de Auditoría
 Envía reportes de auditoría por correo electrónico con archivos adjuntos
 """
 
+from __future__ import annotations
+
 import os
+import io
+import queue
+import atexit
+import gzip
+import shutil
 import logging
-import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.base import MIMEBase
-from email import encoders
-from email.header import Header
-from email.utils import formataddr
-from email.policy import SMTP as SMTP_POLICY
-from typing import List, Optional
+from html import escape
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import TYPE_CHECKING, Callable, Iterable, List, Optional, Tuple
 from datetime import datetime
-from dotenv import load_dotenv
-
-load_dotenv()
-logger = logging.getLogger(__name__)
-
-
-class EmailSender:
-    """Cliente SMTP para envío de reportes de auditoría"""
-
-    def __init__(self):
-        """Inicializa configuración SMTP desde variables de entorno"""
-        self.smtp_server = os.getenv("SMTP_SERVER", "mail.correo-caf.com")
-        self.smtp_port = int(os.getenv("SMTP_PORT", "25"))
-        self.from_email = os.getenv("SMTP_FROM_EMAIL", "auditoria@correo-caf.com")
-        self.from_name = os.getenv("SMTP_FROM_NAME", "Sistema de Auditoría CAF")
-
-        logger.info(f"Cliente SMTP configurado: {self.smtp_server}:{self.smtp_port}")
-
-    def enviar_reporte_auditoria(
-        self,
-        destinatarios: List[str],
-        jsonl_path: Optional[str] = None,
-        html_path: Optional[str] = None,
-        tracking_path: Optional[str] = None,
-        log_path: Optional[str] = None,
-        fecha_reporte: Optional[str] = None
-    ) -> bool:
-        """
-        Envía reporte de auditoría por correo con archivos adjuntos
-
-        Args:
-            destinatarios: Lista de correos electrónicos destinatarios
-            jsonl_path: Ruta del archivo JSONL (datos)
-            html_path: Ruta del archivo HTML (reporte visual)
-            tracking_path: Ruta del archivo de tracking
-            log_path: Ruta del archivo de log
-            fecha_reporte: Fecha del reporte (YYYY-MM-DD), si None usa fecha actual
-
-        Returns:
-            True si se envió exitosamente, False en caso contrario
-        """
-        if not destinatarios:
-            logger.warning("No hay destinatarios configurados, saltando envío de correo")
-            return False
-
-        try:
-            # Crear mensaje con policy que maneja UTF-8
-            msg = MIMEMultipart('alternative', policy=SMTP_POLICY)
-
-            # Configurar headers con encoding UTF-8 correcto
-            msg['From'] = formataddr((self.from_name, self.from_email))
-            msg['To'] = ", ".join(destinatarios)
-            msg['Subject'] = self._generar_asunto(fecha_reporte)
-
-            # Cuerpo del correo (HTML + texto plano)
-            html_body = self._generar_cuerpo_html(
-                jsonl_path, html_path, tracking_path, log_path, fecha_reporte
-            )
-            text_body = self._generar_cuerpo_texto(fecha_reporte)
-
-            msg.attach(MIMEText(text_body, 'plain', 'utf-8'))
-            msg.attach(MIMEText(html_body, 'html', 'utf-8'))
 
-            # Adjuntar archivos - SOLO HTML (más liviano y práctico)
-            archivos_adjuntos = []
+# smtplib, email.* y dotenv se importan dentro de las funciones que los usan:
+# este módulo se importa también en ejecuciones que nunca envían correo
+if TYPE_CHECKING:
+    import ssl
+    import smtplib
+    from email.message import EmailMessage
 
-            if html_path and os.path.exists(html_path):
-                self._adjuntar_archivo(msg, html_path)
-                archivos_adjuntos.append(os.path.basename(html_path))
-            else:
-                logger.warning("No se encontró archivo HTML para adjuntar")
-                return False
-
-            # Los archivos JSONL, tracking y logs están disponibles en el servidor
-            # No es necesario enviarlos por correo (reducir tamaño del email)
-
-            # Enviar correo
-            logger.info(f"Enviando correo a {len(destinatarios)} destinatario(s)...")
-            logger.info(f"Archivos adjuntos: {len(archivos_adjuntos)}")
-
-            # Conexión SMTP sin autenticación (relay interno)
-            with smtplib.SMTP(self.smtp_server, self.smtp_port) as server:
-                server.send_message(msg)
-
-            logger.info(f"✅ Correo enviado exitosamente")
-            for dest in destinatarios:
-                logger.info(f"  - {dest}")
-
-            return True
-
-        except smtplib.SMTPException as e:
-            logger.error(f"❌ Error SMTP al enviar correo: {e}")
-            return False
-        except Exception as e:
-            logger.error(f"❌ Error inesperado al enviar correo: {e}")
-            return False
-
-    def _adjuntar_archivo(self, msg: MIMEMultipart, file_path: str):
-        """Adjunta un archivo al mensaje de correo"""
-        try:
-            with open(file_path, 'rb') as f:
-                part = MIMEBase('application', 'octet-stream')
-                part.set_payload(f.read())
-
-            encoders.encode_base64(part)
-
-            # Codificar nombre de archivo correctamente para UTF-8
-            filename = os.path.basename(file_path)
-            part.add_header(
-                'Content-Disposition',
-                'attachment',
-                filename=('utf-8', '', filename)
-            )
-            msg.attach(part)
-            logger.debug(f"Archivo adjuntado: {filename}")
-
-        except Exception as e:
-            logger.warning(f"No se pudo adjuntar {file_path}: {e}")
-
-    def _generar_asunto(self, fecha_reporte: Optional[str]) -> str:
-        """Genera el asunto del correo"""
-        if not fecha_reporte:
-            fecha_reporte = datetime.now().strftime("%Y-%m-%d")
-
-        return f"📊 Reporte de Auditoría de Urgencias - {fecha_reporte}"
-
-    def _generar_cuerpo_texto(self, fecha_reporte: Optional[str]) -> str:
-        """Genera cuerpo del correo en texto plano"""
-        if not fecha_reporte:
-            fecha_reporte = datetime.now().strftime("%Y-%m-%d")
+logger = logging.getLogger(__name__)
 
-        return f"""
+# Validez del enlace presignado (MinIO/S3 admite como máximo 7 días)
+VALIDEZ_ENLACE_HORAS = 7 * 24
+
+_INSTRUCCIONES_ADJUNTO_TEXTO = (
+    "Para visualizar el reporte completo, descomprima el archivo HTML adjunto "
+    "(.html.gz) antes de abrirlo en su navegador."
+)
+_INSTRUCCIONES_ADJUNTO_HTML = (
+    "Descargue el archivo HTML adjunto (comprimido en .gz), descomprímalo antes de "
+    "abrirlo y ábralo en su navegador web para acceder al reporte completo con "
+    "filtros interactivos por médico."
+)
+_INSTRUCCIONES_ENLACE_TEXTO = (
+    "Para visualizar el reporte completo, descargue el archivo HTML desde el "
+    "siguiente enlace (válido por 7 días) y ábralo en su navegador:\n{url_reporte}"
+)
+_INSTRUCCIONES_ENLACE_HTML = (
+    "Descargue el reporte HTML desde el enlace indicado abajo (válido por 7 días) y "
+    "ábralo en su navegador web para acceder al reporte completo con filtros "
+    "interactivos por médico."
+)
+_AVISO_INCOMPLETA_TEXTO = (
+    "ATENCIÓN: la corrida quedó INCOMPLETA (falló la lectura de las atenciones). "
+    "Los resultados pueden estar vacíos o parciales; revise el log de la corrida.\n\n"
+)
+_AVISO_INCOMPLETA_HTML = (
+    '<p style="color: #b91c1c;"><strong>⚠️ La corrida quedó INCOMPLETA</strong> '
+    '(falló la lectura de las atenciones). Los resultados pueden estar vacíos o '
+    'parciales; revise el log de la corrida.</p>'
+)
+
+
+# Plantillas de cuerpo del correo (se construyen una sola vez al importar el módulo)
+_TEXT_TEMPLATE = """
 Reporte de Auditoría de Urgencias
 Clínica Foianini - {fecha_reporte}
 
-Este correo contiene los reportes de auditoría de las atenciones de urgencia.
+{aviso}Este correo contiene los reportes de auditoría de las atenciones de urgencia.
 
 Archivos adjuntos:
 - JSONL: Datos de auditoría en formato JSON Lines
@@ -158,32 +72,14 @@ Archivos adjuntos:
 - Tracking: Estado del proceso de auditoría
 - Log: Registro detallado de ejecución
 
-Para visualizar el reporte completo, abra el archivo HTML adjunto en su navegador.
+{instrucciones}
 
 ---
 Sistema de Auditoría Automatizada
 Clínica Foianini
-        """.strip()
+""".strip()
 
-    def _generar_cuerpo_html(
-        self,
-        jsonl_path: Optional[str],
-        html_path: Optional[str],
-        tracking_path: Optional[str],
-        log_path: Optional[str],
-        fecha_reporte: Optional[str]
-    ) -> str:
-        """Genera cuerpo del correo en HTML"""
-        if not fecha_reporte:
-            fecha_reporte = datetime.now().strftime("%Y-%m-%d")
-
-        # Calcular tamaño del archivo HTML
-        archivo_info = "Reporte HTML interactivo"
-        if html_path and os.path.exists(html_path):
-            size_mb = os.path.getsize(html_path) / (1024 * 1024)
-            archivo_info = f'Reporte HTML interactivo ({size_mb:.2f} MB)'
-
-        return f"""
+_HTML_TEMPLATE = """
 <!DOCTYPE html>
 <html lang="es">
 <head>
@@ -374,18 +270,19 @@ Clínica Foianini
             <div class="content">
                 <p>Estimado/a,</p>
 
+                {aviso}
                 <p>Se ha completado la auditoría médica automatizada de las atenciones de urgencias del día <strong>{fecha_reporte}</strong>.</p>
 
                 <!-- Destacado -->
                 <div class="highlight">
                     <strong>💡 Cómo visualizar el reporte</strong>
-                    <p>Descargue el archivo HTML adjunto y ábralo en su navegador web para acceder al reporte completo con filtros interactivos por médico.</p>
+                    <p>{instrucciones}</p>
                 </div>
 
                 <!-- Archivo adjunto -->
                 <div class="attachment-box">
                     <div class="attachment-icon">📄</div>
-                    <h3>Archivo Adjunto</h3>
+                    <h3>{titulo_archivo}</h3>
                     <div class="attachment-info">
                         {archivo_info}
                     </div>
@@ -415,7 +312,640 @@ Clínica Foianini
     </div>
 </body>
 </html>
-        """.strip()
+""".strip()
+
+
+# Pool de conexiones SMTP compartido por todo el proceso (LIFO: reutiliza la
+# conexión usada más recientemente, que es la que con más probabilidad sigue viva)
+POOL_MAX_CONEXIONES = 5
+# Se recicla la conexión tras este número de mensajes para respetar límites del relay
+MAX_MENSAJES_POR_CONEXION = 100
+# Reintentos con una conexión nueva si el servidor cierra la sesión en pleno envío
+REINTENTOS_DESCONEXION = 1
+
+
+@dataclass(slots=True)
+class _ConexionSMTP:
+    """Conexión SMTP del pool junto con el número de mensajes enviados por ella"""
+    smtp: smtplib.SMTP
+    mensajes: int = 0
+
+
+_POOL: "queue.LifoQueue[_ConexionSMTP]" = queue.LifoQueue(maxsize=POOL_MAX_CONEXIONES)
+
+
+def _cerrar_conexion(conexion: _ConexionSMTP):
+    """Cierra una conexión SMTP ignorando errores de una conexión ya caída"""
+    import smtplib
+
+    try:
+        conexion.smtp.quit()
+    except (smtplib.SMTPException, OSError):
+        conexion.smtp.close()
+
+
+def _vaciar_pool():
+    """Cierra todas las conexiones inactivas del pool"""
+    while True:
+        try:
+            _cerrar_conexion(_POOL.get_nowait())
+        except queue.Empty:
+            return
+
+
+atexit.register(_vaciar_pool)
+
+
+@dataclass(frozen=True, slots=True)
+class SMTPConfig:
+    """Configuración SMTP leída del entorno (inmutable durante todo el proceso)"""
+    smtp_server: str
+    smtp_port: int
+    from_email: str
+    from_name: str
+    # Conexión con TLS implícito (SMTP_SSL, típicamente puerto 465)
+    use_ssl: bool
+    # Reportes HTML mayores a este tamaño se suben a MinIO y se envía un enlace
+    # en lugar de adjuntarlos (evita codificar y transmitir megabytes por SMTP)
+    max_adjunto_bytes: int
+    # Destinatarios por defecto (EMAIL_DESTINATARIOS, separados por coma)
+    destinatarios: tuple[str, ...]
+
+
+def _parsear_destinatarios(destinatarios_str: str) -> tuple[str, ...]:
+    """Parsea una lista de correos separados por coma (un solo strip por elemento)"""
+    return tuple(filter(None, (email.strip() for email in destinatarios_str.split(","))))
+
+
+@lru_cache(maxsize=1)
+def _load_config() -> SMTPConfig:
+    """Carga .env y construye la configuración SMTP una sola vez por proceso"""
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    return SMTPConfig(
+        smtp_server=os.getenv("SMTP_SERVER", "mail.correo-caf.com"),
+        smtp_port=int(os.getenv("SMTP_PORT", "25")),
+        from_email=os.getenv("SMTP_FROM_EMAIL", "auditoria@correo-caf.com"),
+        from_name=os.getenv("SMTP_FROM_NAME", "Sistema de Auditoría CAF"),
+        use_ssl=os.getenv("SMTP_USE_SSL", "false").lower() == "true",
+        max_adjunto_bytes=int(float(os.getenv("EMAIL_MAX_ADJUNTO_MB", "2")) * 1024 * 1024),
+        destinatarios=_parsear_destinatarios(os.getenv("EMAIL_DESTINATARIOS", ""))
+    )
+
+
+@lru_cache(maxsize=1)
+def _ssl_context() -> ssl.SSLContext:
+    """Contexto TLS compartido: el almacén de certificados se carga una sola vez"""
+    import ssl
+
+    return ssl.create_default_context()
+
+
+class EmailSender:
+    """
+    Cliente SMTP para envío de reportes de auditoría
+
+    Las conexiones SMTP no pertenecen a la instancia: cada envío toma una del
+    pool compartido del proceso y la devuelve al terminar. Usarlo como context
+    manager no cierra conexiones al salir; se cierran con cerrar() o al
+    terminar el proceso (atexit).
+    """
+
+    def __init__(self):
+        """Inicializa configuración SMTP desde variables de entorno"""
+        self.config = _load_config()
+        self.smtp_server = self.config.smtp_server
+        self.smtp_port = self.config.smtp_port
+        self.from_email = self.config.from_email
+        self.from_name = self.config.from_name
+
+        from email.utils import formataddr
+        from email.policy import SMTP as SMTP_POLICY
+
+        # Header From precalculado y ya validado por la policy (codificación RFC 2047
+        # una sola vez); asignar el objeto header a cada mensaje evita re-parsearlo
+        self._from_header = SMTP_POLICY.header_factory(
+            'From', formataddr((self.from_name, self.from_email))
+        )
+
+        logger.info(f"Cliente SMTP configurado: {self.smtp_server}:{self.smtp_port}")
+
+    def __enter__(self) -> "EmailSender":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> bool:
+        """
+        No cierra conexiones: cada envío ya devolvió la suya al pool del proceso,
+        que queda disponible para el siguiente envío (ver cerrar())
+        """
+        return False
+
+    def _tomar_conexion(self) -> _ConexionSMTP:
+        """Toma una conexión viva del pool (verificada con NOOP) o abre una nueva"""
+        import smtplib
+
+        while True:
+            try:
+                conexion = _POOL.get_nowait()
+            except queue.Empty:
+                break
+
+            try:
+                conexion.smtp.noop()
+                return conexion
+            except (smtplib.SMTPException, OSError):
+                logger.debug("Conexión SMTP del pool caída, descartando")
+                _cerrar_conexion(conexion)
+
+        # Sin autenticación (relay interno); TLS implícito opcional con contexto reutilizado
+        if self.config.use_ssl:
+            smtp = smtplib.SMTP_SSL(self.smtp_server, self.smtp_port, context=_ssl_context())
+        else:
+            smtp = smtplib.SMTP(self.smtp_server, self.smtp_port)
+        logger.debug(f"Conexión SMTP abierta: {self.smtp_server}:{self.smtp_port}")
+        return _ConexionSMTP(smtp=smtp)
+
+    def _devolver_conexion(self, conexion: _ConexionSMTP, reutilizable: bool = True):
+        """Devuelve la conexión al pool, o la cierra si falló, alcanzó su límite o el pool está lleno"""
+        if not reutilizable or conexion.mensajes >= MAX_MENSAJES_POR_CONEXION:
+            _cerrar_conexion(conexion)
+            return
+
+        try:
+            _POOL.put_nowait(conexion)
+        except queue.Full:
+            _cerrar_conexion(conexion)
+
+    def cerrar(self):
+        """Cierra todas las conexiones SMTP inactivas del pool"""
+        _vaciar_pool()
+
+    def enviar_reporte_auditoria(
+        self,
+        destinatarios: List[str],
+        jsonl_path: Optional[str] = None,
+        html_path: Optional[str] = None,
+        tracking_path: Optional[str] = None,
+        log_path: Optional[str] = None,
+        fecha_reporte: Optional[str] = None,
+        minio_prefix: Optional[str] = None,
+        objeto_minio: Optional[Callable[[], Optional[str]]] = None,
+        corrida_incompleta: bool = False
+    ) -> bool:
+        """
+        Envía reporte de auditoría por correo con archivos adjuntos
+
+        Toma la conexión SMTP del pool compartido del proceso y la devuelve
+        al terminar, de modo que envíos sucesivos no vuelven a conectarse.
+
+        Args:
+            destinatarios: Lista de correos electrónicos destinatarios
+            jsonl_path: Ruta del archivo JSONL (datos)
+            html_path: Ruta del archivo HTML (reporte visual)
+            tracking_path: Ruta del archivo de tracking
+            log_path: Ruta del archivo de log
+            fecha_reporte: Fecha del reporte (YYYY-MM-DD), si None usa fecha actual
+            minio_prefix: Carpeta en MinIO para subir el HTML si es muy grande para
+                adjuntarlo (ej: "20251114/"); si None usa la fecha actual
+            objeto_minio: Función que devuelve el nombre del objeto del HTML que la
+                corrida ya subió a MinIO (o None si no se subió); si se indica, el
+                HTML no se vuelve a subir y solo se genera el enlace
+            corrida_incompleta: La corrida no terminó: el correo se envía como alerta
+                (asunto y aviso destacados), aunque no haya HTML para adjuntar
+
+        Returns:
+            True si se envió exitosamente, False en caso contrario
+        """
+        import smtplib
+
+        if not destinatarios:
+            logger.warning("No hay destinatarios configurados, saltando envío de correo")
+            return False
+
+        try:
+            msg = self._construir_mensaje(
+                destinatarios, jsonl_path, html_path, tracking_path, log_path, fecha_reporte,
+                minio_prefix, objeto_minio, corrida_incompleta
+            )
+            if msg is None:
+                return False
+
+            # Los archivos JSONL, tracking y logs están disponibles en el servidor
+            # No es necesario enviarlos por correo (reducir tamaño del email)
+
+            # Enviar correo
+            logger.info(f"Enviando correo a {len(destinatarios)} destinatario(s)...")
+            self._enviar(msg, destinatarios)
+
+            logger.info(f"✅ Correo enviado exitosamente")
+            for dest in destinatarios:
+                logger.info(f"  - {dest}")
+
+            return True
+
+        except smtplib.SMTPException as e:
+            logger.error(f"❌ Error SMTP al enviar correo: {e}")
+            return False
+        except Exception as e:
+            logger.error(f"❌ Error inesperado al enviar correo: {e}")
+            return False
+
+    def enviar_reportes(self, reportes: List[dict]) -> List[bool]:
+        """
+        Envía varios reportes en secuencia reutilizando las conexiones del pool
+
+        Cada envío devuelve su conexión al pool y el siguiente la vuelve a tomar,
+        de modo que no se reconecta entre reportes. Las conexiones no se cierran
+        al terminar (ver cerrar()).
+
+        Args:
+            reportes: Lista de diccionarios con los argumentos de
+                enviar_reporte_auditoria (destinatarios, html_path, fecha_reporte, ...)
+
+        Returns:
+            Lista con el resultado de cada envío, en el mismo orden
+        """
+        return [self.enviar_reporte_auditoria(**reporte) for reporte in reportes]
+
+    async def enviar_reporte_auditoria_async(
+        self,
+        destinatarios: List[str],
+        jsonl_path: Optional[str] = None,
+        html_path: Optional[str] = None,
+        tracking_path: Optional[str] = None,
+        log_path: Optional[str] = None,
+        fecha_reporte: Optional[str] = None,
+        minio_prefix: Optional[str] = None,
+        objeto_minio: Optional[Callable[[], Optional[str]]] = None,
+        corrida_incompleta: bool = False
+    ) -> bool:
+        """
+        Versión asíncrona de enviar_reporte_auditoria usando aiosmtplib
+
+        Cada llamada abre su propia conexión, de modo que varios envíos
+        programados con asyncio.gather solapan la espera de red entre sí.
+        Requiere el extra opcional "async" (uv sync --extra async), que instala aiosmtplib.
+
+        Returns:
+            True si se envió exitosamente, False en caso contrario
+            (también si aiosmtplib no está instalado)
+        """
+        import asyncio
+
+        try:
+            import aiosmtplib
+        except ImportError:
+            logger.error("❌ aiosmtplib no está instalado: instale el extra 'async' para el envío asíncrono")
+            return False
+
+        if not destinatarios:
+            logger.warning("No hay destinatarios configurados, saltando envío de correo")
+            return False
+
+        try:
+            # La construcción lee el archivo (y puede subirlo a MinIO): fuera del event loop
+            msg = await asyncio.to_thread(
+                self._construir_mensaje,
+                destinatarios, jsonl_path, html_path, tracking_path, log_path, fecha_reporte,
+                minio_prefix, objeto_minio, corrida_incompleta
+            )
+            if msg is None:
+                return False
+
+            logger.info(f"Enviando correo (async) a {len(destinatarios)} destinatario(s)...")
+
+            # Misma configuración de conexión que la ruta síncrona
+            smtp = aiosmtplib.SMTP(
+                hostname=self.smtp_server,
+                port=self.smtp_port,
+                use_tls=self.config.use_ssl,
+                start_tls=False,
+                tls_context=_ssl_context() if self.config.use_ssl else None
+            )
+            async with smtp:
+                await smtp.send_message(
+                    msg, sender=self.from_email, recipients=destinatarios
+                )
+
+            logger.info(f"✅ Correo enviado exitosamente")
+            for dest in destinatarios:
+                logger.info(f"  - {dest}")
+
+            return True
+
+        except aiosmtplib.SMTPException as e:
+            logger.error(f"❌ Error SMTP al enviar correo: {e}")
+            return False
+        except Exception as e:
+            logger.error(f"❌ Error inesperado al enviar correo: {e}")
+            return False
+
+    async def enviar_reportes_async(self, reportes: List[dict]) -> List[bool]:
+        """
+        Envía varios reportes en paralelo, una conexión SMTP por reporte
+
+        Args:
+            reportes: Lista de diccionarios con los argumentos de
+                enviar_reporte_auditoria_async
+
+        Returns:
+            Lista con el resultado de cada envío, en el mismo orden
+        """
+        import asyncio
+
+        return list(await asyncio.gather(
+            *(self.enviar_reporte_auditoria_async(**reporte) for reporte in reportes)
+        ))
+
+    def enviar_personalizados(self, pares: Iterable[Tuple[str, EmailMessage]]) -> List[bool]:
+        """
+        Envía un mensaje distinto a cada destinatario sobre una misma sesión SMTP
+
+        En lugar de conectar/enviar/desconectar por destinatario, se conecta una
+        vez y se hace un sendmail por par. Si un envío falla, la conexión se
+        descarta y el siguiente par abre (o toma del pool) una nueva; si el
+        servidor cerró la conexión, el mismo par se reintenta con otra.
+
+        Args:
+            pares: Iterable de tuplas (destinatario, mensaje ya construido)
+
+        Returns:
+            Lista con el resultado de cada envío, en el mismo orden
+        """
+        import smtplib
+
+        resultados = []
+        conexion: Optional[_ConexionSMTP] = None
+
+        try:
+            for dest, msg in pares:
+                # Serializar antes de tomar la conexión (como en _enviar); el mismo
+                # payload sirve si el servidor corta la conexión y hay que reintentar
+                payload = msg.as_bytes()
+
+                if conexion is not None and conexion.mensajes >= MAX_MENSAJES_POR_CONEXION:
+                    self._devolver_conexion(conexion)
+                    conexion = None
+
+                for intento in range(1, REINTENTOS_DESCONEXION + 2):
+                    try:
+                        if conexion is None:
+                            conexion = self._tomar_conexion()
+                        conexion.smtp.sendmail(self.from_email, [dest], payload)
+                        conexion.mensajes += 1
+                        resultados.append(True)
+                        break
+                    except (smtplib.SMTPException, OSError) as e:
+                        if conexion is not None:
+                            self._devolver_conexion(conexion, reutilizable=False)
+                            conexion = None
+                        if isinstance(e, smtplib.SMTPServerDisconnected) and intento <= REINTENTOS_DESCONEXION:
+                            logger.warning(f"Conexión SMTP cerrada por el servidor, reintentando envío a {dest}...")
+                            continue
+                        logger.error(f"❌ Error SMTP al enviar correo a {dest}: {e}")
+                        resultados.append(False)
+                        break
+        finally:
+            if conexion is not None:
+                self._devolver_conexion(conexion)
+
+        logger.info(f"Envíos personalizados: {sum(resultados)}/{len(resultados)} exitosos")
+        return resultados
+
+    def _construir_mensaje(
+        self,
+        destinatarios: List[str],
+        jsonl_path: Optional[str],
+        html_path: Optional[str],
+        tracking_path: Optional[str],
+        log_path: Optional[str],
+        fecha_reporte: Optional[str],
+        minio_prefix: Optional[str] = None,
+        objeto_minio: Optional[Callable[[], Optional[str]]] = None,
+        corrida_incompleta: bool = False
+    ) -> Optional[EmailMessage]:
+        """
+        Construye el mensaje MIME completo, o None si no hay HTML para adjuntar
+
+        Una alerta de corrida incompleta se construye igual sin HTML (sin adjunto).
+        """
+        from email.headerregistry import Address
+        from email.utils import parseaddr
+        from email.message import EmailMessage
+        from email.policy import SMTP as SMTP_POLICY
+
+        # Un solo stat del HTML: sirve para validar que existe y para mostrar su tamaño
+        try:
+            html_size = os.stat(html_path).st_size if html_path else None
+        except FileNotFoundError:
+            html_size = None
+
+        if html_size is None:
+            if not corrida_incompleta:
+                logger.warning("No se encontró archivo HTML para adjuntar")
+                return None
+            logger.warning("No se encontró archivo HTML: se envía solo la alerta de corrida incompleta")
+
+        # Reportes grandes: subir a MinIO y enviar enlace en lugar de adjuntar
+        url_reporte = None
+        if html_size is not None and html_size > self.config.max_adjunto_bytes:
+            url_reporte = self._enlace_minio(html_path, minio_prefix, objeto_minio)
+
+        # Crear mensaje con policy que maneja UTF-8
+        msg = EmailMessage(policy=SMTP_POLICY)
+
+        # Configurar headers con encoding UTF-8 correcto
+        msg['From'] = self._from_header
+        # Header To como tupla de Address: la policy lo pliega una sola vez.
+        # parseaddr acepta tanto "a@b.cl" como "Nombre <a@b.cl>" en EMAIL_DESTINATARIOS
+        msg['To'] = tuple(
+            Address(display_name=nombre, addr_spec=direccion)
+            for nombre, direccion in map(parseaddr, destinatarios)
+        )
+        msg['Subject'] = self._generar_asunto(fecha_reporte, corrida_incompleta)
+
+        # Cuerpo del correo (HTML + texto plano)
+        html_body = self._generar_cuerpo_html(
+            jsonl_path, html_path, tracking_path, log_path, fecha_reporte,
+            html_size=html_size, url_reporte=url_reporte, corrida_incompleta=corrida_incompleta
+        )
+        text_body = self._generar_cuerpo_texto(
+            fecha_reporte, url_reporte=url_reporte, corrida_incompleta=corrida_incompleta
+        )
+
+        # set_content + add_alternative generan multipart/alternative; al adjuntar,
+        # EmailMessage lo envuelve automáticamente en multipart/mixed
+        msg.set_content(text_body, cte='quoted-printable')
+        msg.add_alternative(html_body, subtype='html', cte='quoted-printable')
+
+        if url_reporte:
+            logger.info("Reporte HTML enviado como enlace MinIO (sin adjunto)")
+        elif html_size is not None:
+            # Adjuntar archivos - SOLO HTML (más liviano y práctico)
+            self._adjuntar_archivo(msg, html_path)
+            logger.info(f"Archivo adjunto: {os.path.basename(html_path)}.gz")
+
+        return msg
+
+    def _enlace_minio(
+        self,
+        html_path: str,
+        minio_prefix: Optional[str],
+        objeto_minio: Optional[Callable[[], Optional[str]]]
+    ) -> Optional[str]:
+        """
+        Devuelve una URL presignada de descarga del reporte HTML en MinIO
+
+        Si la corrida ya subió el HTML (objeto_minio) se reutiliza ese objeto; si
+        no, se sube aquí bajo minio_prefix, con el mismo gzip que el resto de los
+        artefactos de la corrida.
+
+        Returns:
+            URL presignada, o None si MinIO no está disponible (se adjunta el archivo)
+        """
+        try:
+            from minio_client import get_minio_client
+
+            minio_client = get_minio_client()
+
+            if objeto_minio is not None:
+                object_name = objeto_minio()
+                if object_name is None:
+                    logger.warning("El reporte HTML no quedó en MinIO. Se adjuntará el reporte.")
+                    return None
+            else:
+                prefix = minio_prefix or f"{datetime.now():%Y%m%d}/"
+                if not minio_client.upload_file(html_path, prefix=prefix, comprimir=True):
+                    return None
+                object_name = prefix.rstrip('/') + '/' + os.path.basename(html_path)
+
+            return minio_client.get_file_url(object_name, expires_hours=VALIDEZ_ENLACE_HORAS)
+
+        except ImportError:
+            logger.warning("Módulo minio_client no disponible. Se adjuntará el reporte.")
+            return None
+        except Exception as e:
+            logger.warning(f"No se pudo subir el reporte a MinIO, se adjuntará: {e}")
+            return None
+
+    def _enviar(self, msg: EmailMessage, destinatarios: List[str]):
+        """Envía el mensaje por una conexión del pool (sin reconectar si sigue viva)"""
+        import smtplib
+
+        # Serializar una sola vez y antes de tocar la conexión: el socket solo se usa
+        # para transmitir, y el mismo payload sirve si hay que reintentar
+        payload = msg.as_bytes()
+
+        for intento in range(1, REINTENTOS_DESCONEXION + 2):
+            conexion = self._tomar_conexion()
+            reutilizable = False
+            try:
+                conexion.smtp.sendmail(self.from_email, destinatarios, payload)
+                conexion.mensajes += 1
+                reutilizable = True
+                return
+            except smtplib.SMTPServerDisconnected:
+                if intento > REINTENTOS_DESCONEXION:
+                    raise
+                logger.warning("Conexión SMTP cerrada por el servidor, reintentando envío...")
+            finally:
+                self._devolver_conexion(conexion, reutilizable)
+
+    def _adjuntar_archivo(self, msg: EmailMessage, file_path: str):
+        """Adjunta un archivo al mensaje de correo, comprimido con gzip (.gz)"""
+        try:
+            # El HTML es muy repetitivo: comprimirlo antes de codificar en base64
+            # reduce varias veces los bytes enviados por SMTP
+            comprimido = io.BytesIO()
+            with open(file_path, 'rb') as f, \
+                    gzip.GzipFile(fileobj=comprimido, mode='wb', compresslevel=6) as gz:
+                shutil.copyfileobj(f, gz)
+
+            # add_attachment codifica en base64 y la policy SMTP codifica el
+            # nombre de archivo (RFC 2231) si tiene caracteres no ASCII
+            filename = os.path.basename(file_path) + '.gz'
+            msg.add_attachment(
+                comprimido.getvalue(),
+                maintype='application',
+                subtype='gzip',
+                filename=filename
+            )
+            logger.debug(f"Archivo adjuntado: {filename}")
+
+        except Exception as e:
+            logger.warning(f"No se pudo adjuntar {file_path}: {e}")
+
+    def _generar_asunto(self, fecha_reporte: Optional[str], corrida_incompleta: bool = False) -> str:
+        """Genera el asunto del correo"""
+        if not fecha_reporte:
+            fecha_reporte = datetime.now().strftime("%Y-%m-%d")
+
+        if corrida_incompleta:
+            return f"⚠️ CORRIDA INCOMPLETA - Auditoría de Urgencias - {fecha_reporte}"
+        return f"📊 Reporte de Auditoría de Urgencias - {fecha_reporte}"
+
+    def _generar_cuerpo_texto(
+        self,
+        fecha_reporte: Optional[str],
+        url_reporte: Optional[str] = None,
+        corrida_incompleta: bool = False
+    ) -> str:
+        """Genera cuerpo del correo en texto plano"""
+        if not fecha_reporte:
+            fecha_reporte = datetime.now().strftime("%Y-%m-%d")
+
+        if url_reporte:
+            instrucciones = _INSTRUCCIONES_ENLACE_TEXTO.format(url_reporte=url_reporte)
+        else:
+            instrucciones = _INSTRUCCIONES_ADJUNTO_TEXTO
+
+        return _TEXT_TEMPLATE.format(
+            fecha_reporte=fecha_reporte,
+            aviso=_AVISO_INCOMPLETA_TEXTO if corrida_incompleta else "",
+            instrucciones=instrucciones
+        )
+
+    def _generar_cuerpo_html(
+        self,
+        jsonl_path: Optional[str],
+        html_path: Optional[str],
+        tracking_path: Optional[str],
+        log_path: Optional[str],
+        fecha_reporte: Optional[str],
+        html_size: Optional[int] = None,
+        url_reporte: Optional[str] = None,
+        corrida_incompleta: bool = False
+    ) -> str:
+        """Genera cuerpo del correo en HTML (html_size en bytes, ya obtenido por el llamador)"""
+        if not fecha_reporte:
+            fecha_reporte = datetime.now().strftime("%Y-%m-%d")
+
+        # Tamaño del archivo HTML (se omite si el llamador no lo conoce)
+        size_mb = f"{html_size / (1024 * 1024):.2f} MB" if html_size is not None else None
+
+        if url_reporte:
+            titulo_archivo = "Reporte en MinIO"
+            instrucciones = _INSTRUCCIONES_ENLACE_HTML
+            archivo_info = f'<a href="{escape(url_reporte)}">Descargar reporte HTML</a>'
+            if size_mb:
+                archivo_info += f" ({size_mb})"
+        elif html_size is None:
+            titulo_archivo = "Sin reporte"
+            instrucciones = "Revise el log de la corrida (disponible en MinIO) para el detalle del error."
+            archivo_info = "No se generó el reporte HTML de esta corrida"
+        else:
+            titulo_archivo = "Archivo Adjunto"
+            instrucciones = _INSTRUCCIONES_ADJUNTO_HTML
+            archivo_info = f"Reporte HTML interactivo comprimido (.gz, {size_mb} sin comprimir)"
+
+        return _HTML_TEMPLATE.format(
+            fecha_reporte=fecha_reporte,
+            aviso=_AVISO_INCOMPLETA_HTML if corrida_incompleta else "",
+            archivo_info=archivo_info,
+            titulo_archivo=titulo_archivo,
+            instrucciones=instrucciones
+        )
 
 
 # --- Función Helper para uso en main.py ---
@@ -425,7 +955,10 @@ def enviar_reporte_por_correo(
     html_path: Optional[str] = None,
     tracking_path: Optional[str] = None,
     log_path: Optional[str] = None,
-    fecha_reporte: Optional[str] = None
+    fecha_reporte: Optional[str] = None,
+    minio_prefix: Optional[str] = None,
+    objeto_minio: Optional[Callable[[], Optional[str]]] = None,
+    corrida_incompleta: bool = False
 ) -> bool:
     """
     Función helper para enviar reporte de auditoría por correo
@@ -436,34 +969,33 @@ def enviar_reporte_por_correo(
         tracking_path: Ruta del archivo de tracking
         log_path: Ruta del archivo de log
         fecha_reporte: Fecha del reporte (YYYY-MM-DD)
+        minio_prefix: Carpeta en MinIO de la corrida (ver enviar_reporte_auditoria)
+        objeto_minio: Nombre del HTML ya subido por la corrida (ver enviar_reporte_auditoria)
+        corrida_incompleta: Enviar como alerta de corrida incompleta (ver enviar_reporte_auditoria)
 
     Returns:
         True si se envió exitosamente, False en caso contrario
     """
     try:
-        # Obtener destinatarios desde .env
-        destinatarios_str = os.getenv("EMAIL_DESTINATARIOS", "")
-        if not destinatarios_str:
-            logger.warning("No hay destinatarios configurados (EMAIL_DESTINATARIOS en .env)")
-            return False
-
-        # Parsear lista de destinatarios (separados por coma)
-        destinatarios = [email.strip() for email in destinatarios_str.split(",") if email.strip()]
-
+        # Destinatarios desde .env (parseados una sola vez junto con la configuración)
+        destinatarios = _load_config().destinatarios
         if not destinatarios:
-            logger.warning("Lista de destinatarios vacía")
+            logger.warning("No hay destinatarios configurados (EMAIL_DESTINATARIOS en .env)")
             return False
 
         # Crear cliente de correo y enviar
-        email_sender = EmailSender()
-        return email_sender.enviar_reporte_auditoria(
-            destinatarios=destinatarios,
-            jsonl_path=jsonl_path,
-            html_path=html_path,
-            tracking_path=tracking_path,
-            log_path=log_path,
-            fecha_reporte=fecha_reporte
-        )
+        with EmailSender() as email_sender:
+            return email_sender.enviar_reporte_auditoria(
+                destinatarios=destinatarios,
+                jsonl_path=jsonl_path,
+                html_path=html_path,
+                tracking_path=tracking_path,
+                log_path=log_path,
+                fecha_reporte=fecha_reporte,
+                minio_prefix=minio_prefix,
+                objeto_minio=objeto_minio,
+                corrida_incompleta=corrida_incompleta
+            )
 
     except Exception as e:
         logger.error(f"Error en enviar_reporte_por_correo: {e}")
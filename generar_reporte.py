@@ -1443,6 +1443,33 @@ def generar_html(data, analisis, archivo_salida):
 
     return html
 
+def generar_reporte_html(archivo_entrada):
+    """
+    Genera el reporte HTML a partir de un archivo JSONL de auditorías.
+
+    Punto de entrada reutilizable (main.py lo invoca en el mismo proceso).
+
+    Args:
+        archivo_entrada: Ruta del archivo JSONL
+
+    Returns:
+        Tupla (ruta del HTML generado, análisis)
+    """
+    data = cargar_datos(archivo_entrada)
+    analisis = analizar_datos(data)
+
+    # Generar nombre de archivo de salida
+    archivo_salida = archivo_entrada.replace('.jsonl', '.html')
+
+    html = generar_html(data, analisis, archivo_salida)
+
+    # Escribir archivo HTML
+    with open(archivo_salida, 'w', encoding='utf-8') as f:
+        f.write(html)
+
+    return archivo_salida, analisis
+
+
 if __name__ == "__main__":
     import sys
 
@@ -1453,23 +1480,8 @@ if __name__ == "__main__":
     archivo_entrada = sys.argv[1]
 
     try:
-        print("Cargando datos...")
-        data = cargar_datos(archivo_entrada)
-        print(f"  [OK] {len(data)} atenciones cargadas")
-
-        print("Analizando datos...")
-        analisis = analizar_datos(data)
-        print(f"  [OK] Análisis completado")
-
-        # Generar nombre de archivo de salida
-        archivo_salida = archivo_entrada.replace('.jsonl', '.html')
-
         print("Generando reporte HTML...")
-        html = generar_html(data, analisis, archivo_salida)
-
-        # Escribir archivo HTML
-        with open(archivo_salida, 'w', encoding='utf-8') as f:
-            f.write(html)
+        archivo_salida, analisis = generar_reporte_html(archivo_entrada)
 
         print(f"\n{'='*60}")
         print(f"REPORTE GENERADO EXITOSAMENTE")
@@ -1,26 +1,99 @@
 import os
-import json
-import time
+import re
+import sys
+import asyncio
+import atexit
+import queue
+import hashlib
+import sqlite3
+import tempfile
+import textwrap
 import logging
+import logging.handlers
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import lru_cache, partial
 from dotenv import load_dotenv
-from pydantic import BaseModel, Field, ValidationError
-from typing import List, Optional, Dict, Any
+from pydantic import BaseModel, Field
+from typing import List, Optional, Dict, Any, Tuple, Iterator, Callable
 import litellm
+import orjson
 import pymysql
-from pymysql.cursors import DictCursor
-
-# Configurar logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(f'logs/auditoria_{datetime.now():%Y%m%d}.log', encoding='utf-8'),
-        logging.StreamHandler()
-    ]
+from pymysql.cursors import DictCursor, SSDictCursor
+from utils.archivos import rutas_existentes
+
+class _FileHandlerConBuffer(logging.FileHandler):
+    """
+    FileHandler con buffer de 64KB.
+
+    logging.FileHandler hace flush al disco en cada registro; aquí solo se fuerza
+    en ERROR o superior. El resto se escribe al llenarse el buffer, con
+    flush_logs() o al salir (logging.shutdown hace flush y cierra los handlers).
+    """
+    def _open(self):
+        return open(self.baseFilename, self.mode, encoding=self.encoding, errors=self.errors, buffering=1 << 16)
+
+    def emit(self, record):
+        try:
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(self.format(record) + self.terminator)
+            if record.levelno >= logging.ERROR:
+                self.stream.flush()
+        except Exception:
+            self.handleError(record)
+
+
+# Nivel de la consola: en ejecuciones no interactivas (schedules) se puede subir
+# a WARNING para no emitir los logs INFO por atención (el archivo los guarda igual)
+_nivel_consola = os.getenv("LOG_CONSOLA_NIVEL", "INFO").upper()
+_nivel_consola_valido = _nivel_consola in logging.getLevelNamesMapping()
+_consola = logging.StreamHandler()
+_consola.setLevel(_nivel_consola if _nivel_consola_valido else logging.INFO)
+
+# Instante de inicio de la corrida: fija el nombre del log, el de los archivos de
+# salida y la fecha del correo (aunque la corrida termine pasada la medianoche)
+INICIO_CORRIDA = datetime.now()
+LOG_FILENAME = f'logs/auditoria_{INICIO_CORRIDA:%Y%m%d}.log'
+
+_archivo_log = _FileHandlerConBuffer(LOG_FILENAME, encoding='utf-8')
+
+_formato_log = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+for _handler in (_archivo_log, _consola):
+    _handler.setFormatter(_formato_log)
+
+# Configurar logging: el root solo encola los registros y un hilo (QueueListener)
+# hace la escritura a archivo/consola, fuera del hilo que audita
+_cola_logs: "queue.Queue[logging.LogRecord]" = queue.Queue(-1)
+_listener_logs = logging.handlers.QueueListener(
+    _cola_logs, _archivo_log, _consola, respect_handler_level=True
 )
+_encolador = logging.handlers.QueueHandler(_cola_logs)
+# Solo el mensaje (y traceback): fecha y nivel los agrega el formato de los handlers
+_encolador.setFormatter(logging.Formatter('%(message)s'))
+logging.basicConfig(level=logging.INFO, handlers=[_encolador])
+_listener_logs.start()
+# atexit es LIFO: se detiene (y vacía la cola) antes del logging.shutdown final
+atexit.register(_listener_logs.stop)
 logger = logging.getLogger(__name__)
 
+if not _nivel_consola_valido:
+    logger.warning(f"LOG_CONSOLA_NIVEL inválido ('{_nivel_consola}'): se usa INFO")
+
+# Loggers de librerías que emiten un INFO por request HTTP
+for _nombre in ("LiteLLM", "httpx"):
+    logging.getLogger(_nombre).setLevel(logging.WARNING)
+
+
+def flush_logs():
+    """Escribe los registros encolados y hace flush (antes de subir/enviar el archivo de log)"""
+    # stop() procesa todo lo que quedó en la cola y espera al hilo del listener
+    _listener_logs.stop()
+    for handler in _listener_logs.handlers:
+        handler.flush()
+    _listener_logs.start()
+
 # --- 1. Modelo de Datos Pydantic para Auditoría de Urgencia ---
 
 class AuditoriaUrgenciaResultado(BaseModel):
@@ -74,125 +147,210 @@ class AuditoriaUrgenciaResultado(BaseModel):
     )
 
 
+# Bloque de código markdown opcional (```json ... ```) alrededor del JSON del LLM;
+# todas las partes son opcionales, por lo que el patrón siempre coincide
+_FENCE_RE = re.compile(r"^\s*(?:```(?:json)?)?\s*(.*?)\s*(?:```)?\s*$", re.DOTALL)
+
+# Campos obligatorios del resultado (para la verificación liviana de model_construct)
+_CAMPOS_AUDITORIA = frozenset(AuditoriaUrgenciaResultado.model_fields)
+
+
 # --- 2. Componente: Cliente MySQL ---
 
+@lru_cache(maxsize=32)
+def _leer_query(query_dir: str, query_name: str) -> str:
+    """Lee y cachea una plantilla de query SQL desde un archivo .sql."""
+    path = os.path.join(query_dir, f"{query_name}.sql")
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return f.read()
+    except FileNotFoundError:
+        raise ValueError(f"Archivo de query no encontrado en: {path}")
+
+
 class MCPClient:
-    """Cliente para interactuar con MySQL"""
-    def __init__(self, query_dir: str = "queries"):
+    """
+    Cliente para interactuar con MySQL.
+
+    Las conexiones de pymysql no son thread-safe: cada query toma una conexión
+    de un pool pequeño (queue.LifoQueue) y la devuelve al terminar, de modo que
+    varios hilos (p. ej. la precarga de detalles) pueden consultar a la vez.
+
+    El pool guarda (conexión, instante de devolución): una conexión que estuvo
+    ociosa más de PING_TRAS_SEGUNDOS se valida con ping() antes de reutilizarla,
+    en lugar de descubrir en la query que MySQL la cerró (wait_timeout).
+    """
+    PING_TRAS_SEGUNDOS = 30
+
+    def __init__(self, query_dir: str = "queries", max_conexiones: int = 4):
         self.query_dir = query_dir
-        self.connection = None
-        self._connect()
+        self._pool = queue.LifoQueue(maxsize=max_conexiones)
+        self._pool.put((self._connect(), time.monotonic()))
 
-    def _connect(self):
-        """Establece conexión con MySQL"""
+    def _connect(self, cursorclass=DictCursor) -> pymysql.connections.Connection:
+        """Establece una nueva conexión con MySQL"""
         try:
-            self.connection = pymysql.connect(
+            connection = pymysql.connect(
                 host=os.getenv("MYSQL_HOST", "127.0.0.1"),
                 port=int(os.getenv("MYSQL_PORT", "3306")),
                 user=os.getenv("MYSQL_USER"),
                 password=os.getenv("MYSQL_PASSWORD"),
                 database=os.getenv("MYSQL_DATABASE"),
-                cursorclass=DictCursor,
-                connect_timeout=10
+                cursorclass=cursorclass,
+                connect_timeout=10,
+                # Solo lecturas: sin autocommit, una conexión reutilizada leería
+                # siempre la misma instantánea (REPEATABLE READ) durante toda la corrida
+                autocommit=True
             )
 
             # CRÍTICO: Aumentar límite de GROUP_CONCAT para capturar evoluciones completas
             # El límite por defecto (1024 bytes) trunca las evoluciones clínicas con JSON
             # Configurar a 10MB (10485760 bytes) para manejar historiales extensos
-            with self.connection.cursor() as cursor:
+            with connection.cursor() as cursor:
                 cursor.execute("SET SESSION group_concat_max_len = 10485760")
 
             logger.info("Conectado a MySQL (group_concat_max_len configurado a 10MB)")
+            return connection
         except Exception as e:
             logger.error(f"Error al conectar con MySQL: {e}")
             raise
 
     def _load_query(self, query_name: str) -> str:
-        """Carga una plantilla de query SQL desde un archivo .sql."""
-        path = os.path.join(self.query_dir, f"{query_name}.sql")
+        """Carga una plantilla de query SQL desde un archivo .sql (leída una sola vez por proceso)."""
+        return _leer_query(self.query_dir, query_name)
+
+    def _tomar_conexion(self) -> pymysql.connections.Connection:
+        """Toma una conexión viva del pool o crea una nueva si no hay disponibles"""
+        while True:
+            try:
+                connection, devuelta_en = self._pool.get_nowait()
+            except queue.Empty:
+                return self._connect()
+            if time.monotonic() - devuelta_en <= self.PING_TRAS_SEGUNDOS:
+                return connection
+            try:
+                # Sin reconnect: una reconexión implícita perdería group_concat_max_len
+                connection.ping(reconnect=False)
+                return connection
+            except Exception:
+                logger.info("Conexión MySQL ociosa cerrada por el servidor, se descarta")
+                if connection.open:
+                    connection.close()
+
+    def _devolver_conexion(self, connection: pymysql.connections.Connection):
+        """Devuelve una conexión al pool (o la cierra si el pool está lleno)"""
         try:
-            with open(path, "r", encoding="utf-8") as f:
-                return f.read()
-        except FileNotFoundError:
-            raise ValueError(f"Archivo de query no encontrado en: {path}")
+            self._pool.put_nowait((connection, time.monotonic()))
+        except queue.Full:
+            connection.close()
 
-    def _execute_query(self, query: str) -> Optional[List[Dict[str, Any]]]:
-        """Ejecuta una query contra MySQL"""
+    def _execute_query(self, query: str, params: Optional[Any] = None) -> Optional[List[Dict[str, Any]]]:
+        """Ejecuta una query contra MySQL (params se interpola con el escape de pymysql)"""
+        connection = None
         try:
-            if not self.connection or not self.connection.open:
-                self._connect()
+            connection = self._tomar_conexion()
 
-            with self.connection.cursor() as cursor:
-                cursor.execute(query)
+            with connection.cursor() as cursor:
+                cursor.execute(query, params)
                 results = cursor.fetchall()
-                return results if results else []
+
+            self._devolver_conexion(connection)
+            return results if results else []
 
         except Exception as e:
             logger.error(f"Error al ejecutar query: {e}")
+            # No reutilizar una conexión que falló a mitad de la query
+            if connection is not None and connection.open:
+                connection.close()
             return None
 
-    def get_todas_atenciones_24h(self) -> Optional[List[Dict]]:
-        """Obtiene TODAS las atenciones de urgencias de las últimas 24 horas"""
+    def _execute_query_stream(self, query: str, params: Optional[Any] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Ejecuta una query con cursor sin buffer (SSDictCursor) y entrega las filas una a una.
+
+        Usa una conexión dedicada (fuera del pool): un cursor sin buffer bloquea la
+        conexión hasta leer la última fila. Si la lectura falla, se registra el error
+        y se relanza: la corrida no debe tomar un listado parcial por completo.
+        """
+        connection = None
+        try:
+            connection = self._connect(cursorclass=SSDictCursor)
+            with connection.cursor() as cursor:
+                cursor.execute(query, params)
+                for row in cursor:
+                    yield row
+
+        except Exception as e:
+            logger.error(f"Error al ejecutar query (lectura en streaming): {e}")
+            raise
+        finally:
+            if connection is not None and connection.open:
+                connection.close()
+
+    def get_todas_atenciones_24h(self) -> Iterator[Dict]:
+        """Obtiene TODAS las atenciones de urgencias de las últimas 24 horas (en streaming)"""
         query_template = self._load_query("get_todas_atenciones_24h")
-        return self._execute_query(query_template)
+        return self._execute_query_stream(query_template)
 
     def get_detalle_atencion(
         self, persona_numero: int, cuenta_gestion: int, cuenta_internacion: int, cuenta_id: int
     ) -> Optional[Dict]:
         """Obtiene el detalle completo de una atención de urgencias específica"""
         query_template = self._load_query("get_detalle_atencion")
-        query_sql = query_template.format(
-            persona_numero=persona_numero,
-            cuenta_gestion=cuenta_gestion,
-            cuenta_internacion=cuenta_internacion,
-            cuenta_id=cuenta_id
-        )
-        results = self._execute_query(query_sql)
+        results = self._execute_query(query_template, {
+            "persona_numero": persona_numero,
+            "cuenta_gestion": cuenta_gestion,
+            "cuenta_internacion": cuenta_internacion,
+            "cuenta_id": cuenta_id
+        })
 
         if results and len(results) > 0:
             return results[0]
         return None
 
+    def get_detalles_atenciones(self, keys: List[Tuple]) -> Optional[Dict[Tuple, Dict]]:
+        """
+        Obtiene el detalle completo de varias atenciones en una sola query.
+
+        Args:
+            keys: Lista de tuplas (persona_numero, cuenta_gestion, cuenta_internacion, cuenta_id)
+
+        Returns:
+            Diccionario {clave: detalle} (None si la query falló)
+        """
+        if not keys:
+            return {}
+
+        query_template = self._load_query("get_detalles_atenciones")
+        results = self._execute_query(query_template, (tuple(keys),))
+        if results is None:
+            return None
+
+        return {
+            (row['persona_numero'], row['cuenta_gestion'], row['cuenta_internacion'], row['cuenta_id']): row
+            for row in results
+        }
+
     def __del__(self):
-        """Cierra la conexión al destruir el objeto"""
-        if self.connection and self.connection.open:
-            self.connection.close()
+        """Cierra las conexiones del pool al destruir el objeto"""
+        pool = getattr(self, "_pool", None)
+        while pool is not None and not pool.empty():
+            connection, _ = pool.get_nowait()
+            if connection.open:
+                connection.close()
 
 
 # --- 3. Componente: Auditor LLM con OpenRouter ---
 
 class AuditorLLM:
     """Auditor médico usando Claude Sonnet 4.5/4 a través de OpenRouter con LiteLLM"""
-    def __init__(self, reintentos: int = 3):
-        self.api_key = os.getenv("OPENROUTER_API_KEY")
-        os.environ["OPENROUTER_API_KEY"] = self.api_key
-
-        model_base = os.getenv("DEFAULT_MODEL")
-        model_fallback = os.getenv("FALLBACK_MODEL")
-
-        self.model_principal = f"openrouter/{model_base}"
-        self.model_fallback = f"openrouter/{model_fallback}"
-        self.reintentos = reintentos
 
-        litellm.drop_params = True
-        litellm.set_verbose = False
+    # Modo JSON estricto del proveedor (litellm.drop_params lo descarta si el modelo no lo soporta);
+    # el strip de bloques markdown en _parsear_respuesta queda como respaldo
+    _RESPONSE_FORMAT = {"type": "json_object"}
 
-    def auditar_atencion(
-        self,
-        historial: str,
-        id_evolucion: int,
-        fecha_atencion: str,
-        diagnostico: str,
-        id_persona: int,
-        id_medico: int,
-        nombre_medico: str,
-        nombre_paciente: str,  # NUEVO
-        cuenta_gestion: int,   # NUEVO
-        cuenta_internacion: int  # NUEVO
-    ) -> Optional[AuditoriaUrgenciaResultado]:
-        """Audita una atención de urgencias según guías internacionales"""
-
-        prompt_sistema = """
+    # Prompts invariantes: se construyen una sola vez al definir la clase
+    _PROMPT_SISTEMA = textwrap.dedent("""
         Eres un experto auditor médico especializado en medicina de urgencias.
         Tu tarea es evaluar si la atención de urgencias proporcionada cumple con guías clínicas
         internacionales reconocidas como:
@@ -274,9 +432,9 @@ class AuditorLLM:
         - La internación es una decisión CORRECTA para observación prolongada
         - Solo evalúa el tiempo en urgencias si el paciente fue dado de ALTA a domicilio directamente
         - Frases clave que indican internación: "INDICA INTERNACIÓN", "PASA A PISO", "TRASLADO A PISO", "INGRESA A PISO"
-        """
+        """)
 
-        prompt_usuario = f"""
+    _PROMPT_USUARIO_TMPL = textwrap.dedent("""
         Analiza la siguiente atención de urgencias y auditala según guías médicas internacionales.
 
         **Información de la atención:**
@@ -339,61 +497,343 @@ class AuditorLLM:
 
         NO incluyas los campos id_medico, nombre_medico, id_persona_paciente, id_evolucion, fecha_atencion, diagnostico_urgencia, nombre_paciente, cuenta_gestion, cuenta_internacion.
         Responde SOLO con el JSON, sin texto adicional.
-        """
+        """)
 
-        modelos = [self.model_principal, self.model_fallback]
-
-        for modelo in modelos:
-            for intento in range(self.reintentos):
-                try:
-                    response = litellm.completion(
-                        model=modelo,
-                        messages=[
-                            {"role": "system", "content": prompt_sistema},
-                            {"role": "user", "content": prompt_usuario}
-                        ],
-                        temperature=0.3,
-                    )
+    def __init__(self, reintentos: int = 3):
+        self.api_key = os.getenv("OPENROUTER_API_KEY")
+        os.environ["OPENROUTER_API_KEY"] = self.api_key
+
+        model_base = os.getenv("DEFAULT_MODEL")
+        model_fallback = os.getenv("FALLBACK_MODEL")
+
+        self.model_principal = f"openrouter/{model_base}"
+        self.model_fallback = f"openrouter/{model_fallback}"
+        self.reintentos = reintentos
+
+        litellm.drop_params = True
+        litellm.set_verbose = False
+
+        # Un solo event loop para toda la corrida: litellm cachea sus clientes
+        # async ligados al loop en que se crearon (asyncio.run crearía uno por auditoría)
+        self._loop = asyncio.new_event_loop()
+
+        # Cache de respuestas por contenido del prompt (evita re-auditar historiales idénticos)
+        self._cache = None
+        if os.getenv("LLM_CACHE_ENABLED", "true").lower() == "true":
+            self._cache = self._abrir_cache(os.getenv("LLM_CACHE_PATH", "output/llm_cache.sqlite"))
+
+    def cerrar(self):
+        """Cierra el event loop de las llamadas async (si sigue abierto)"""
+        if not self._loop.is_closed():
+            self._loop.run_until_complete(self._loop.shutdown_asyncgens())
+            self._loop.close()
+
+    def contar_tokens(self, texto: str) -> int:
+        """Cuenta los tokens de un texto con el tokenizador del modelo principal"""
+        try:
+            return litellm.token_counter(model=self.model_principal, text=texto)
+        except Exception:
+            # Estimación conservadora si el tokenizador no está disponible
+            return len(texto) // 3
+
+    @staticmethod
+    def _abrir_cache(path: str) -> Optional[sqlite3.Connection]:
+        """Abre (o crea) la cache SQLite de respuestas del LLM"""
+        try:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            conexion = sqlite3.connect(path)
+            conexion.execute("CREATE TABLE IF NOT EXISTS cache (hash TEXT PRIMARY KEY, response TEXT)")
+            return conexion
+        except sqlite3.Error as e:
+            logger.warning(f"No se pudo abrir la cache del LLM en '{path}': {e}. Se continúa sin cache.")
+            return None
+
+    @staticmethod
+    def _clave_cache(messages: List[Dict[str, str]]) -> str:
+        """Hash sha256 del prompt completo (system + user)"""
+        return hashlib.sha256("".join(m["content"] for m in messages).encode("utf-8")).hexdigest()
+
+    def _leer_cache(self, clave: str, item: Dict) -> Optional[AuditoriaUrgenciaResultado]:
+        """Devuelve el resultado cacheado para una clave (None si no hay o no es válido)"""
+        if self._cache is None:
+            return None
+        fila = self._cache.execute("SELECT response FROM cache WHERE hash = ?", (clave,)).fetchone()
+        if fila is None:
+            return None
+        try:
+            resultado = self._parsear_respuesta(fila[0], **item)
+        except Exception:
+            return None
+        logger.info(f"  Respuesta del LLM reutilizada desde cache para la evolución {item['id_evolucion']}")
+        return resultado
+
+    def _guardar_cache(self, clave: str, content: str):
+        """Guarda en cache una respuesta del LLM ya validada"""
+        if self._cache is None:
+            return
+        with self._cache:
+            self._cache.execute("INSERT OR REPLACE INTO cache (hash, response) VALUES (?, ?)", (clave, content))
+
+    def _construir_mensajes(
+        self,
+        historial: str,
+        id_evolucion: int,
+        fecha_atencion: str,
+        diagnostico: str,
+        id_persona: int,
+        id_medico: int,
+        nombre_medico: str,
+        **_
+    ) -> List[Dict[str, str]]:
+        """Construye los mensajes (system + user) de la auditoría de una atención"""
+        prompt_usuario = self._PROMPT_USUARIO_TMPL.format_map({
+            "id_evolucion": id_evolucion,
+            "fecha_atencion": fecha_atencion,
+            "diagnostico": diagnostico,
+            "id_persona": id_persona,
+            "id_medico": id_medico,
+            "nombre_medico": nombre_medico,
+            "historial": historial,
+        })
+
+        return [
+            {"role": "system", "content": self._PROMPT_SISTEMA},
+            {"role": "user", "content": prompt_usuario}
+        ]
+
+    def _parsear_respuesta(
+        self,
+        content: str,
+        id_evolucion: int,
+        fecha_atencion: str,
+        diagnostico: str,
+        id_persona: int,
+        id_medico: int,
+        nombre_medico: str,
+        nombre_paciente: str,
+        cuenta_gestion: int,
+        cuenta_internacion: int,
+        **_
+    ) -> AuditoriaUrgenciaResultado:
+        """Convierte la respuesta del LLM en un resultado validado (lanza excepción si es inválida)"""
+        data = orjson.loads(_FENCE_RE.match(content).group(1))
+
+        # Agregar campos que conocemos
+        data["id_medico"] = id_medico
+        data["nombre_medico"] = nombre_medico
+        data["id_persona_paciente"] = id_persona
+        data["nombre_paciente"] = nombre_paciente
+        data["id_evolucion"] = id_evolucion
+        data["fecha_atencion"] = str(fecha_atencion)
+        data["cuenta_gestion"] = cuenta_gestion
+        data["cuenta_internacion"] = cuenta_internacion
+        data["diagnostico_urgencia"] = diagnostico or "Pendiente de codificación CIE-9"
+
+        # Los campos conocidos vienen de la BD y las claves del LLM están fijadas por el
+        # prompt: se evita la validación completa de Pydantic y solo se verifica lo mínimo
+        faltantes = _CAMPOS_AUDITORIA - data.keys()
+        if faltantes:
+            raise ValueError(f"Faltan campos en la respuesta del LLM: {sorted(faltantes)}")
+
+        # Como el modo lax de Pydantic: se acepta 87, 87.0 o "87", pero no 87.9 (int() lo truncaría)
+        score = data["score_calidad"]
+        try:
+            entero = not isinstance(score, bool) and float(score).is_integer()
+        except (TypeError, ValueError):
+            entero = False
+        if not entero:
+            raise ValueError(f"score_calidad no es un entero: {score!r}")
+        data["score_calidad"] = int(float(score))
+        if not 0 <= data["score_calidad"] <= 100:
+            raise ValueError(f"score_calidad fuera de rango (0-100): {data['score_calidad']}")
+
+        return AuditoriaUrgenciaResultado.model_construct(**data)
+
+    def auditar_atencion(
+        self,
+        historial: str,
+        id_evolucion: int,
+        fecha_atencion: str,
+        diagnostico: str,
+        id_persona: int,
+        id_medico: int,
+        nombre_medico: str,
+        nombre_paciente: str,  # NUEVO
+        cuenta_gestion: int,   # NUEVO
+        cuenta_internacion: int  # NUEVO
+    ) -> Optional[AuditoriaUrgenciaResultado]:
+        """Audita una atención de urgencias según guías internacionales"""
+        item = dict(
+            historial=historial,
+            id_evolucion=id_evolucion,
+            fecha_atencion=fecha_atencion,
+            diagnostico=diagnostico,
+            id_persona=id_persona,
+            id_medico=id_medico,
+            nombre_medico=nombre_medico,
+            nombre_paciente=nombre_paciente,
+            cuenta_gestion=cuenta_gestion,
+            cuenta_internacion=cuenta_internacion
+        )
+        messages = self._construir_mensajes(**item)
+        clave = self._clave_cache(messages)
+
+        resultado = self._leer_cache(clave, item)
+        if resultado:
+            return resultado
+
+        return self._loop.run_until_complete(self._auditar_atencion_async(messages, clave, item))
+
+    async def _intentar_modelo(self, modelo: str, messages: List[Dict[str, str]], item: Dict) -> Tuple[str, AuditoriaUrgenciaResultado]:
+        """Un intento de auditoría con un modelo: devuelve (respuesta cruda, resultado validado)"""
+        response = await litellm.acompletion(
+            model=modelo,
+            messages=messages,
+            temperature=0.3,
+            response_format=self._RESPONSE_FORMAT,
+        )
+        content = response.choices[0].message.content
+        return content, self._parsear_respuesta(content, **item)
 
-                    content = response.choices[0].message.content.strip()
-                    if content.startswith("```json"):
-                        content = content[7:]
-                    if content.startswith("```"):
-                        content = content[3:]
-                    if content.endswith("```"):
-                        content = content[:-3]
-                    content = content.strip()
-
-                    data = json.loads(content)
-
-                    # Agregar campos que conocemos
-                    data["id_medico"] = id_medico
-                    data["nombre_medico"] = nombre_medico
-                    data["id_persona_paciente"] = id_persona
-                    data["nombre_paciente"] = nombre_paciente
-                    data["id_evolucion"] = id_evolucion
-                    data["fecha_atencion"] = str(fecha_atencion)
-                    data["cuenta_gestion"] = cuenta_gestion
-                    data["cuenta_internacion"] = cuenta_internacion
-                    data["diagnostico_urgencia"] = diagnostico or "Pendiente de codificación CIE-9"
-
-                    return AuditoriaUrgenciaResultado(**data)
-
-                except (Exception, ValidationError, json.JSONDecodeError) as e:
-                    logger.warning(f"Intento {intento + 1}/{self.reintentos} fallido con {modelo}. Error: {e}")
-                    time.sleep(2**intento)
-
-            logger.warning(f"Fallaron todos los intentos con {modelo}, probando siguiente modelo...")
-
-        logger.error(f"Fallaron todos los modelos para la evolución {id_evolucion}")
+    async def _auditar_atencion_async(
+        self, messages: List[Dict[str, str]], clave: str, item: Dict
+    ) -> Optional[AuditoriaUrgenciaResultado]:
+        """
+        Ciclo de reintentos con carrera entre modelos.
+
+        La primera ronda usa solo model_principal. Tras un fallo, cada ronda lanza
+        model_principal y model_fallback en paralelo y se queda con la primera
+        respuesta válida (la otra se cancela). Solo se espera (backoff exponencial)
+        cuando el proveedor respondió con rate limit (429). self.reintentos es el
+        máximo de rondas.
+        """
+        modelos_ronda = [self.model_principal]
+
+        for ronda in range(self.reintentos):
+            tareas = {
+                asyncio.create_task(self._intentar_modelo(modelo, messages, item)): modelo
+                for modelo in modelos_ronda
+            }
+            rate_limit = False
+            try:
+                while tareas:
+                    terminadas, _ = await asyncio.wait(tareas, return_when=asyncio.FIRST_COMPLETED)
+                    for tarea in terminadas:
+                        modelo = tareas.pop(tarea)
+                        try:
+                            content, resultado = tarea.result()
+                        except litellm.RateLimitError as e:
+                            rate_limit = True
+                            logger.warning(f"Intento {ronda + 1}/{self.reintentos} con {modelo} limitado por rate limit. Error: {e}")
+                        except Exception as e:
+                            logger.warning(f"Intento {ronda + 1}/{self.reintentos} fallido con {modelo}. Error: {e}")
+                        else:
+                            self._guardar_cache(clave, content)
+                            return resultado
+            finally:
+                for tarea in tareas:
+                    tarea.cancel()
+                # Esperar las canceladas: en el loop compartido quedarían pendientes
+                # (y sus excepciones como "Task exception was never retrieved")
+                await asyncio.gather(*tareas, return_exceptions=True)
+
+            modelos_ronda = [self.model_principal, self.model_fallback]
+            if rate_limit and ronda + 1 < self.reintentos:
+                await asyncio.sleep(2**ronda)
+
+        logger.error(f"Fallaron todos los modelos para la evolución {item['id_evolucion']}")
         return None
 
+    def auditar_atenciones_batch(self, items: List[Dict]) -> List[Optional[AuditoriaUrgenciaResultado]]:
+        """
+        Audita un lote de atenciones con litellm.batch_completion (llamadas concurrentes).
+
+        Solo las atenciones cuya respuesta falló o no pudo parsearse pasan por
+        el ciclo de reintentos/modelo de respaldo de auditar_atencion; el lote
+        completo nunca se reintenta.
+
+        Args:
+            items: Lista de diccionarios con los mismos argumentos de auditar_atencion
+
+        Returns:
+            Lista de resultados en el mismo orden que items (None si falló)
+        """
+        if not items:
+            return []
+
+        mensajes = [self._construir_mensajes(**item) for item in items]
+        claves = [self._clave_cache(messages) for messages in mensajes]
+        resultados = [self._leer_cache(clave, item) for clave, item in zip(claves, items)]
+
+        # Solo se envían al LLM las atenciones sin respuesta en cache
+        pendientes = [i for i, resultado in enumerate(resultados) if resultado is None]
+        if not pendientes:
+            return resultados
+
+        try:
+            respuestas = litellm.batch_completion(
+                model=self.model_principal,
+                messages=[mensajes[i] for i in pendientes],
+                temperature=0.3,
+                response_format=self._RESPONSE_FORMAT,
+            )
+        except Exception as e:
+            logger.warning(f"Falló el envío del lote con {self.model_principal}. Error: {e}")
+            respuestas = [e] * len(pendientes)
+
+        for i, response in zip(pendientes, respuestas):
+            item = items[i]
+            try:
+                if isinstance(response, Exception):
+                    raise response
+                content = response.choices[0].message.content
+                resultados[i] = self._parsear_respuesta(content, **item)
+                self._guardar_cache(claves[i], content)
+            except Exception as e:
+                logger.warning(f"Respuesta del lote fallida para la evolución {item['id_evolucion']}. Error: {e}")
+                resultados[i] = self.auditar_atencion(**item)
+
+        return resultados
+
 
 # --- 4. Función Auxiliar: Formateo de datos para LLM ---
 
-def formatear_atencion_para_llm(detalle: Dict) -> str:
-    """Formatea los datos de la atención en texto estructurado para el LLM"""
-    import json as json_module
+_SEP80 = "-" * 80
+_SEP80_DOBLE = "=" * 80
+
+def formatear_atencion_para_llm(
+    detalle: Dict,
+    max_tokens: Optional[int] = None,
+    contar_tokens: Optional[Callable[[str], int]] = None
+) -> str:
+    """
+    Formatea los datos de la atención en texto estructurado para el LLM.
+
+    Args:
+        detalle: Fila de get_detalle_atencion / get_detalles_atenciones
+        max_tokens: Tope de tokens del historial (None = sin tope)
+        contar_tokens: Función que cuenta los tokens de un texto (requerida con max_tokens)
+
+    Si el historial supera max_tokens se omiten primero las evoluciones más
+    antiguas y luego los estudios de imagen más antiguos (siempre se conserva
+    el más reciente de cada uno). Las demás secciones, incluidas LABORATORIOS
+    y SOLICITUDES, no se recortan porque las reglas del prompt dependen de ellas.
+    """
+    return formatear_atencion_con_tokens(detalle, max_tokens, contar_tokens)[0]
+
+
+def formatear_atencion_con_tokens(
+    detalle: Dict,
+    max_tokens: Optional[int] = None,
+    contar_tokens: Optional[Callable[[str], int]] = None
+) -> Tuple[str, Optional[int]]:
+    """
+    Igual que formatear_atencion_para_llm, devolviendo además los tokens del historial.
+
+    Returns:
+        (historial, tokens): tokens es None sin contar_tokens, y una estimación
+        (proporción tokens/carácter del texto completo) si hubo recorte
+    """
 
     # Parsear evoluciones clínicas
     evoluciones = []
@@ -406,11 +846,11 @@ def formatear_atencion_para_llm(detalle: Dict) -> str:
 
         for evo_json in evo_parts:
             try:
-                evoluciones.append(json_module.loads(evo_json))
-            except json_module.JSONDecodeError:
+                evoluciones.append(orjson.loads(evo_json))
+            except orjson.JSONDecodeError:
                 pass
 
-    texto = f"""
+    partes = [f"""
 =================================================================================
 ATENCIÓN DE URGENCIAS - DETALLE COMPLETO
 =================================================================================
@@ -424,73 +864,81 @@ INFORMACIÓN DE LA CUENTA:
 =================================================================================
 EVOLUCIONES CLÍNICAS
 =================================================================================
-"""
+"""]
+
+    # Rangos (inicio, fin) de cada evolución / imagen dentro de partes, para el recorte
+    bloques_evo = []
+    bloques_img = []
 
     for i, evo in enumerate(evoluciones, 1):
-        texto += f"\n--- Evolución #{i} ---\n"
-        texto += f"Fecha: {evo.get('fecha', 'N/A')}\n"
-        texto += f"Tipo: {evo.get('tipo_evento', 'N/A')}\n"
-        texto += f"Profesional: {evo.get('profesional', 'N/A')}\n"
+        inicio = len(partes)
+        partes.append(f"\n--- Evolución #{i} ---\n")
+        partes.append(f"Fecha: {evo.get('fecha', 'N/A')}\n")
+        partes.append(f"Tipo: {evo.get('tipo_evento', 'N/A')}\n")
+        partes.append(f"Profesional: {evo.get('profesional', 'N/A')}\n")
 
         if evo.get('diagnosticos'):
-            texto += f"\nDiagnósticos CIE9:\n{evo['diagnosticos']}\n"
+            partes.append(f"\nDiagnósticos CIE9:\n{evo['diagnosticos']}\n")
         if evo.get('comentario_clinico'):
-            texto += f"\nComentario Clínico:\n{evo['comentario_clinico']}\n"
+            partes.append(f"\nComentario Clínico:\n{evo['comentario_clinico']}\n")
         if evo.get('plan_medico'):
-            texto += f"\nPlan Médico:\n{evo['plan_medico']}\n"
+            partes.append(f"\nPlan Médico:\n{evo['plan_medico']}\n")
         if evo.get('medicamentos_prescritos'):
-            texto += f"\nMedicamentos Prescritos:\n{evo['medicamentos_prescritos']}\n"
+            partes.append(f"\nMedicamentos Prescritos:\n{evo['medicamentos_prescritos']}\n")
 
-        texto += "-" * 80 + "\n"
+        partes.append(_SEP80 + "\n")
+        bloques_evo.append((inicio, len(partes)))
 
     if detalle.get('signos_vitales'):
-        texto += f"""
+        partes.append(f"""
 =================================================================================
 SIGNOS VITALES
 =================================================================================
 {detalle['signos_vitales']}
 
-"""
+""")
 
     if detalle.get('ejecuciones_medicamentos'):
-        texto += f"""
+        partes.append(f"""
 =================================================================================
 EJECUCIONES DE MEDICAMENTOS (ENFERMERÍA)
 =================================================================================
 {detalle['ejecuciones_medicamentos']}
 
-"""
+""")
 
     if detalle.get('notas_enfermeria'):
-        texto += f"""
+        partes.append(f"""
 =================================================================================
 NOTAS DE ENFERMERÍA
 =================================================================================
 {detalle['notas_enfermeria']}
 
-"""
+""")
 
     if detalle.get('laboratorios'):
-        texto += f"""
+        partes.append(f"""
 =================================================================================
 RESULTADOS DE LABORATORIO
 =================================================================================
 {detalle['laboratorios']}
 
-"""
+""")
 
     if detalle.get('estudios_imagen'):
         imagenes = detalle['estudios_imagen'].split('\n---IMAGEN---\n')
-        texto += f"""
+        idx_titulo_img = len(partes)
+        partes.append(f"""
 =================================================================================
 ESTUDIOS DE IMAGEN
 =================================================================================
-"""
+""")
         for img in imagenes:
-            texto += f"{img}\n{'-'*80}\n"
+            bloques_img.append((len(partes), len(partes) + 1))
+            partes.append(f"{img}\n{_SEP80}\n")
 
     if detalle.get('solicitudes_laboratorio'):
-        texto += f"""
+        partes.append(f"""
 =================================================================================
 SOLICITUDES DE LABORATORIO (ÓRDENES MÉDICAS)
 =================================================================================
@@ -501,10 +949,10 @@ FUE SOLICITADO aunque no tenga resultado en la sección anterior.
 {detalle['solicitudes_laboratorio']}
 
 
-"""
+""")
 
     if detalle.get('solicitudes_imagen'):
-        texto += f"""
+        partes.append(f"""
 =================================================================================
 SOLICITUDES DE IMAGEN (ÓRDENES MÉDICAS)
 =================================================================================
@@ -515,48 +963,137 @@ en la sección "ESTUDIOS DE IMAGEN" anterior.
 
 {detalle['solicitudes_imagen']}
 
-"""
-
-    texto += "=" * 80 + "\n"
-    return texto
+""")
+
+    partes.append(_SEP80_DOBLE + "\n")
+    texto = "".join(partes)
+
+    if contar_tokens is None:
+        return texto, None
+    tokens = contar_tokens(texto)
+    if max_tokens is None or tokens <= max_tokens:
+        return texto, tokens
+
+    # Recorte: el costo de cada bloque se estima por caracteres con la proporción global
+    tokens_por_caracter = tokens / len(texto)
+    exceso = tokens - max_tokens
+
+    def _omitir(bloques: List[Tuple[int, int]]) -> int:
+        nonlocal exceso
+        omitidos = 0
+        for inicio, fin in bloques[:-1]:  # el más reciente siempre se conserva
+            if exceso <= 0:
+                break
+            exceso -= sum(len(p) for p in partes[inicio:fin]) * tokens_por_caracter
+            partes[inicio:fin] = [""] * (fin - inicio)
+            omitidos += 1
+        return omitidos
+
+    omitidas_evo = _omitir(bloques_evo)
+    omitidas_img = _omitir(bloques_img)
+
+    if omitidas_evo:
+        partes[0] += f"\n[NOTA: Se omitieron las {omitidas_evo} evoluciones más antiguas por longitud del historial]\n"
+    if omitidas_img:
+        partes[idx_titulo_img] += f"[NOTA: Se omitieron los {omitidas_img} estudios de imagen más antiguos por longitud del historial]\n"
+
+    logger.warning(
+        f"  Historial de ~{tokens} tokens supera el tope de {max_tokens}: "
+        f"se omitieron {omitidas_evo} evoluciones y {omitidas_img} estudios de imagen antiguos"
+    )
+    return "".join(partes), round(max_tokens + exceso)
 
 
 # --- 5. Componente: Gestor de Estado (simplificado para producción) ---
 
 class GestorDeEstado:
-    """Gestiona el estado del proceso de auditoría para permitir reanudación"""
+    """
+    Gestiona el estado del proceso de auditoría para permitir reanudación.
+
+    El estado se persiste como un log append-only (.jsonl): cada marca agrega una
+    línea {"id": ..., "status": ...} y al cargar se reproduce el log (la última
+    marca de cada id prevalece).
+    """
     def __init__(self, archivo_estado: str):
         self.archivo_estado = archivo_estado
+        self._fh = None
+        self._linea_truncada = False
         self.estado = self._cargar_estado()
 
     def _cargar_estado(self) -> Dict:
         if not os.path.exists(self.archivo_estado):
             return {}
+        estado = {}
+        invalidas = 0
         try:
-            with open(self.archivo_estado, "r", encoding="utf-8") as f:
-                return json.load(f)
-        except (json.JSONDecodeError, IOError):
+            with open(self.archivo_estado, "rb") as f:
+                for linea in f:
+                    self._linea_truncada = not linea.endswith(b"\n")
+                    try:
+                        registro = orjson.loads(linea)
+                    except orjson.JSONDecodeError:
+                        registro = None
+                    if not isinstance(registro, dict) or "id" not in registro:
+                        # Línea truncada (p. ej. corte abrupto del proceso) o sin id: se ignora
+                        logger.warning(f"Línea inválida en '{self.archivo_estado}'. Se ignora.")
+                        invalidas += 1
+                        continue
+                    estado[str(registro.pop("id"))] = registro
+        except IOError:
             logger.warning(f"No se pudo leer '{self.archivo_estado}'. Se creará uno nuevo.")
             return {}
 
-    def _guardar_estado(self):
-        with open(self.archivo_estado, "w", encoding="utf-8") as f:
-            json.dump(self.estado, f, indent=4, ensure_ascii=False)
+        # Reescribir sin las líneas inválidas para no advertirlas en cada carga
+        if invalidas:
+            self._compactar(estado)
+        return estado
+
+    def _compactar(self, estado: Dict):
+        """Reescribe el log con una sola marca por id (escritura atómica)"""
+        directorio = os.path.dirname(self.archivo_estado) or "."
+        try:
+            with tempfile.NamedTemporaryFile("wb", dir=directorio, delete=False) as tmp:
+                for id_evolucion, registro in estado.items():
+                    tmp.write(orjson.dumps({"id": id_evolucion, **registro}, option=orjson.OPT_APPEND_NEWLINE))
+            os.replace(tmp.name, self.archivo_estado)
+            self._linea_truncada = False
+            logger.info(f"Log de estado '{self.archivo_estado}' compactado ({len(estado)} marcas)")
+        except OSError as e:
+            logger.warning(f"No se pudo compactar '{self.archivo_estado}': {e}")
+
+    def _guardar_estado(self, id_evolucion: int):
+        """Agrega al log la marca actual de una evolución"""
+        if self._fh is None:
+            self._fh = open(self.archivo_estado, "ab")
+            if self._linea_truncada:
+                # Cerrar la línea incompleta para no corromper la siguiente marca
+                self._fh.write(b"\n")
+        self._fh.write(orjson.dumps(
+            {"id": str(id_evolucion), **self.estado[str(id_evolucion)]},
+            option=orjson.OPT_APPEND_NEWLINE
+        ))
+        self._fh.flush()
+
+    def cerrar(self):
+        """Cierra el log de estado (si fue abierto)"""
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
 
     def marcar_pendiente(self, id_evolucion: int):
         """Marca una evolución como pendiente"""
         self.estado[str(id_evolucion)] = {"status": "pendiente"}
-        self._guardar_estado()
+        self._guardar_estado(id_evolucion)
 
     def marcar_completado(self, id_evolucion: int):
         """Marca una evolución como completada"""
         self.estado[str(id_evolucion)] = {"status": "completado"}
-        self._guardar_estado()
+        self._guardar_estado(id_evolucion)
 
     def marcar_fallido(self, id_evolucion: int, error: str = ""):
         """Marca una evolución como fallida"""
         self.estado[str(id_evolucion)] = {"status": "fallido", "error": error}
-        self._guardar_estado()
+        self._guardar_estado(id_evolucion)
 
     def esta_procesado(self, id_evolucion: int) -> bool:
         """Verifica si una evolución ya fue procesada"""
@@ -568,107 +1105,146 @@ class GestorDeEstado:
 
 class OrquestadorAuditoriaProduccion:
     """Orquesta el proceso completo de auditoría diaria de urgencias"""
-    def __init__(self, output_file: str, state_file: str):
+    def __init__(self, output_file: str, state_file: str, tamano_lote: int = 16):
         load_dotenv()
         self.mcp_client = MCPClient()
         self.auditor_llm = AuditorLLM()
         self.output_file = output_file
         self.gestor_estado = GestorDeEstado(archivo_estado=state_file)
+        self.tamano_lote = tamano_lote
+        self.max_tokens_historial = int(os.getenv("HISTORIAL_MAX_TOKENS", "60000"))
+        self._out_fh = None
 
-    def run_auditoria_24h(self):
-        """Ejecuta la auditoría de todas las atenciones de las últimas 24 horas"""
+    def run_auditoria_24h(self) -> bool:
+        """
+        Ejecuta la auditoría de todas las atenciones de las últimas 24 horas
+
+        Returns:
+            False si la corrida quedó incompleta (no se pudo leer el listado completo)
+        """
         logger.info("="*80)
         logger.info("INICIO DE AUDITORÍA DIARIA - URGENCIAS")
         logger.info("="*80)
 
         # 1. Obtener TODAS las atenciones de las últimas 24 horas
         logger.info("Obteniendo atenciones de las últimas 24 horas...")
-        atenciones = self.mcp_client.get_todas_atenciones_24h()
 
-        if not atenciones or len(atenciones) == 0:
+        # 2. Una sola pasada sobre las filas (a medida que llegan): agrupar por médico
+        # (para logs y estadísticas) y separar pendientes de ya procesadas
+        total_atenciones = 0
+        medicos_map = {}
+        pendientes = []
+        ya_procesadas = []
+        try:
+            for idx, atencion in enumerate(self.mcp_client.get_todas_atenciones_24h(), 1):
+                total_atenciones = idx
+                medico_id = atencion['id_medico']
+                if medico_id not in medicos_map:
+                    medicos_map[medico_id] = {
+                        'nombre': atencion['nombre_medico'],
+                        'atenciones': 0
+                    }
+                medicos_map[medico_id]['atenciones'] += 1
+
+                # Crear ID único basado en la CUENTA (no en evolución)
+                # Esto garantiza que cada atención se procese solo una vez
+                id_unico = f"{atencion['cuenta_gestion']}-{atencion['cuenta_internacion']}-{atencion['cuenta_id']}"
+                cuenta_formato = f"{atencion['cuenta_gestion']}/{atencion['cuenta_internacion']}"
+
+                # Verificar si ya fue procesada (solo se conserva lo necesario para el log)
+                if self.gestor_estado.esta_procesado(id_unico):
+                    ya_procesadas.append((idx, cuenta_formato))
+                else:
+                    pendientes.append((idx, id_unico, cuenta_formato, atencion))
+        except Exception as e:
+            # Listado a medias: no se audita una lista parcial como si fuera la corrida completa
+            logger.error(f"CORRIDA INCOMPLETA: falló la lectura de las atenciones de las últimas 24 horas: {e}")
+            logger.error("Se omite la auditoría; al reejecutar, el tracking salta lo ya auditado")
+            self.cerrar()
+            return False
+
+        if not total_atenciones:
             logger.warning("No se encontraron atenciones en las últimas 24 horas")
-            return
+            return True
 
-        total_atenciones = len(atenciones)
         logger.info(f"Total de atenciones encontradas: {total_atenciones}")
 
-        # 2. Agrupar por médico (para logs y estadísticas)
-        medicos_map = {}
-        for atencion in atenciones:
-            medico_id = atencion['id_medico']
-            if medico_id not in medicos_map:
-                medicos_map[medico_id] = {
-                    'nombre': atencion['nombre_medico'],
-                    'atenciones': []
-                }
-            medicos_map[medico_id]['atenciones'].append(atencion)
-
         logger.info(f"Total de médicos que atendieron: {len(medicos_map)}")
         for medico_id, info in medicos_map.items():
-            logger.info(f"  - {info['nombre']}: {len(info['atenciones'])} atenciones")
+            logger.info(f"  - {info['nombre']}: {info['atenciones']} atenciones")
 
-        # 3. Procesar cada atención
+        # 3. Procesar las atenciones pendientes en lotes concurrentes
         logger.info("\nIniciando procesamiento de atenciones...")
-        procesadas = 0
+        procesadas = len(ya_procesadas)
         fallidas = 0
 
-        for idx, atencion in enumerate(atenciones, 1):
-            # Crear ID único basado en la CUENTA (no en evolución)
-            # Esto garantiza que cada atención se procese solo una vez
-            id_unico = f"{atencion['cuenta_gestion']}-{atencion['cuenta_internacion']}-{atencion['cuenta_id']}"
-            cuenta_formato = f"{atencion['cuenta_gestion']}/{atencion['cuenta_internacion']}"
-
-            # Verificar si ya fue procesada
-            if self.gestor_estado.esta_procesado(id_unico):
-                logger.info(f"[{idx}/{total_atenciones}] Atención {cuenta_formato} ya procesada. Saltando.")
-                procesadas += 1
-                continue
-
-            logger.info(f"\n[{idx}/{total_atenciones}] Procesando atención {cuenta_formato}")
-            logger.info(f"  Médico: {atencion['nombre_medico']}")
-            logger.info(f"  Paciente: {atencion['nombre_paciente']}")
-            logger.info(f"  Fecha: {atencion['fecha_atencion']}")
-
-            # 3.1 Obtener detalle completo
-            detalle = self.mcp_client.get_detalle_atencion(
-                persona_numero=atencion['id_persona_paciente'],
-                cuenta_gestion=atencion['cuenta_gestion'],
-                cuenta_internacion=atencion['cuenta_internacion'],
-                cuenta_id=atencion['cuenta_id']
-            )
+        for idx, cuenta_formato in ya_procesadas:
+            logger.info(f"[{idx}/{total_atenciones}] Atención {cuenta_formato} ya procesada. Saltando.")
+
+        lotes = [
+            pendientes[inicio:inicio + self.tamano_lote]
+            for inicio in range(0, len(pendientes), self.tamano_lote)
+        ]
+
+        # El detalle de cada lote se obtiene en un hilo aparte: mientras el LLM
+        # audita un lote, ya se está consultando en MySQL el detalle del siguiente
+        with ThreadPoolExecutor(max_workers=1) as precarga:
+            futuro = precarga.submit(self._obtener_detalles, lotes[0]) if lotes else None
+
+            for n_lote, pendientes_lote in enumerate(lotes):
+                # 3.1 Obtener detalle completo del lote (ya precargado)
+                detalles = futuro.result()
+                if n_lote + 1 < len(lotes):
+                    futuro = precarga.submit(self._obtener_detalles, lotes[n_lote + 1])
+
+                lote = []
+                items = []
+
+                for idx, id_unico, cuenta_formato, atencion in pendientes_lote:
+                    logger.info(f"\n[{idx}/{total_atenciones}] Procesando atención {cuenta_formato}")
+                    logger.info(f"  Médico: {atencion['nombre_medico']}")
+                    logger.info(f"  Paciente: {atencion['nombre_paciente']}")
+                    logger.info(f"  Fecha: {atencion['fecha_atencion']}")
+
+                    detalle = detalles.get(self._clave_detalle(atencion))
+
+                    if not detalle:
+                        logger.error(f"  Error al obtener detalle de la atención")
+                        self.gestor_estado.marcar_fallido(id_unico, "Error al obtener detalle")
+                        fallidas += 1
+                        continue
+
+                    # 3.2 Formatear para LLM (con tope de tokens)
+                    # Los tokens salen del mismo conteo del recorte (sin retokenizar el historial)
+                    historial, historial_tokens = formatear_atencion_con_tokens(
+                        detalle,
+                        max_tokens=self.max_tokens_historial,
+                        contar_tokens=self.auditor_llm.contar_tokens
+                    )
+                    logger.info(f"  historial_tokens: {historial_tokens}")
 
-            if not detalle:
-                logger.error(f"  Error al obtener detalle de la atención")
-                self.gestor_estado.marcar_fallido(id_unico, "Error al obtener detalle")
-                fallidas += 1
-                continue
-
-            # 3.2 Formatear para LLM
-            historial = formatear_atencion_para_llm(detalle)
-
-            # 3.3 Auditar con IA
-            resultado = self.auditor_llm.auditar_atencion(
-                historial=historial,
-                id_evolucion=atencion.get('id_evolucion', 0),  # Para compatibilidad
-                fecha_atencion=str(atencion['fecha_atencion']),
-                diagnostico=atencion.get('diagnosticos', ''),
-                id_persona=atencion['id_persona_paciente'],
-                id_medico=atencion['id_medico'],
-                nombre_medico=atencion['nombre_medico'],
-                nombre_paciente=atencion['nombre_paciente'],
-                cuenta_gestion=atencion['cuenta_gestion'],
-                cuenta_internacion=atencion['cuenta_internacion']
-            )
+                    lote.append((idx, id_unico, cuenta_formato))
+                    items.append(self._item_auditoria(atencion, historial))
 
-            if resultado:
-                self.guardar_resultado(resultado)
-                self.gestor_estado.marcar_completado(id_unico)
-                logger.info(f"  [OK] Auditoría completada. Score: {resultado.score_calidad}/100")
-                procesadas += 1
-            else:
-                self.gestor_estado.marcar_fallido(id_unico, "Error en auditoría LLM")
-                logger.error(f"  [ERROR] Auditoría fallida")
-                fallidas += 1
+                if not items:
+                    continue
+
+                # 3.3 Auditar con IA (todas las atenciones del lote en paralelo)
+                logger.info(f"\nAuditando lote de {len(items)} atenciones...")
+                resultados = self.auditor_llm.auditar_atenciones_batch(items)
+
+                for (idx, id_unico, cuenta_formato), resultado in zip(lote, resultados):
+                    if resultado:
+                        self.guardar_resultado(resultado)
+                        self.gestor_estado.marcar_completado(id_unico)
+                        logger.info(f"  [{idx}/{total_atenciones}] [OK] Auditoría {cuenta_formato} completada. Score: {resultado.score_calidad}/100")
+                        procesadas += 1
+                    else:
+                        self.gestor_estado.marcar_fallido(id_unico, "Error en auditoría LLM")
+                        logger.error(f"  [{idx}/{total_atenciones}] [ERROR] Auditoría {cuenta_formato} fallida")
+                        fallidas += 1
+
+        self.cerrar()
 
         # 4. Resumen final
         logger.info("\n" + "="*80)
@@ -679,16 +1255,206 @@ class OrquestadorAuditoriaProduccion:
         logger.info(f"Fallidas: {fallidas}")
         logger.info(f"Resultados guardados en: {self.output_file}")
         logger.info("="*80)
+        return True
+
+    def _obtener_detalles(self, pendientes_lote: List[Tuple]) -> Dict[Tuple, Dict]:
+        """Obtiene el detalle de un lote de atenciones pendientes, indexado por clave"""
+        claves = [self._clave_detalle(atencion) for _, _, _, atencion in pendientes_lote]
+        detalles = self.mcp_client.get_detalles_atenciones(claves)
+        if detalles is None:
+            logger.warning("Falló la consulta masiva de detalles, se consultará atención por atención")
+            detalles = {clave: self.mcp_client.get_detalle_atencion(*clave) for clave in claves}
+        return detalles
+
+    @staticmethod
+    def _clave_detalle(atencion: Dict) -> Tuple:
+        """Clave (persona_numero, cuenta_gestion, cuenta_internacion, cuenta_id) de una atención"""
+        return (
+            atencion['id_persona_paciente'],
+            atencion['cuenta_gestion'],
+            atencion['cuenta_internacion'],
+            atencion['cuenta_id']
+        )
+
+    @staticmethod
+    def _item_auditoria(atencion: Dict, historial: str) -> Dict:
+        """Arma los argumentos de AuditorLLM.auditar_atencion para una atención"""
+        return dict(
+            historial=historial,
+            id_evolucion=atencion.get('id_evolucion', 0),  # Para compatibilidad
+            fecha_atencion=str(atencion['fecha_atencion']),
+            diagnostico=atencion.get('diagnosticos', ''),
+            id_persona=atencion['id_persona_paciente'],
+            id_medico=atencion['id_medico'],
+            nombre_medico=atencion['nombre_medico'],
+            nombre_paciente=atencion['nombre_paciente'],
+            cuenta_gestion=atencion['cuenta_gestion'],
+            cuenta_internacion=atencion['cuenta_internacion']
+        )
 
     def guardar_resultado(self, resultado: AuditoriaUrgenciaResultado):
         """Guarda un resultado de auditoría en formato JSONL"""
-        with open(self.output_file, "a", encoding="utf-8") as f:
-            f.write(resultado.model_dump_json() + "\n")
+        # El archivo se abre una sola vez (al primer resultado) y se mantiene abierto
+        if self._out_fh is None:
+            self._out_fh = open(self.output_file, "ab", buffering=1 << 16)
+        self._out_fh.write(orjson.dumps(resultado.model_dump(), option=orjson.OPT_APPEND_NEWLINE))
+        # Flush antes de marcar como completado: si el proceso muere, el estado
+        # nunca indica "completado" para un resultado que no llegó al disco
+        self._out_fh.flush()
+
+    def cerrar(self):
+        """Cierra el archivo de resultados, el log de estado y el event loop del auditor"""
+        if self._out_fh is not None:
+            self._out_fh.close()
+            self._out_fh = None
+        self.gestor_estado.cerrar()
+        self.auditor_llm.cerrar()
+
+    def __del__(self):
+        """Cierra el archivo de resultados al destruir el objeto"""
+        if getattr(self, "gestor_estado", None) is not None:
+            self.cerrar()
+
+
+# --- 7. Post-proceso: Subida a MinIO y Envío por Correo ---
+
+class _AgrupadorLogs(logging.Filter):
+    """
+    Retiene los registros de los loggers indicados para emitirlos juntos más tarde
+
+    MinIO y correo corren en paralelo: sin esto sus líneas se intercalan en el log.
+    """
+    def __init__(self, *loggers: str):
+        super().__init__()
+        self._retenidos: Dict[str, List[logging.LogRecord]] = {nombre: [] for nombre in loggers}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        retenidos = self._retenidos.get(record.name.partition('.')[0])
+        if retenidos is None:
+            return True
+        retenidos.append(record)
+        return False
+
+    def emitir(self, nombre: str):
+        """Deja de retener los registros de nombre y emite, en orden, los retenidos"""
+        for record in self._retenidos.pop(nombre, []):
+            _encolador.handle(record)
+
+
+def artefactos_corrida(output_jsonl: str, state_file: str) -> Dict[str, Optional[str]]:
+    """
+    Rutas de los archivos de la corrida, con None para los que no existen
+
+    Las claves coinciden con los argumentos de upload_auditoria_files y
+    enviar_reporte_por_correo, que reciben el mismo diccionario.
+    """
+    output_html = output_jsonl.replace('.jsonl', '.html')
+    # Un scandir por carpeta en vez de un stat por archivo
+    existentes = rutas_existentes(output_jsonl, output_html, state_file, LOG_FILENAME)
+
+    return {
+        "jsonl_path": output_jsonl if output_jsonl in existentes else None,
+        "html_path": output_html if output_html in existentes else None,
+        "tracking_path": state_file if state_file in existentes else None,
+        "log_path": LOG_FILENAME if LOG_FILENAME in existentes else None
+    }
+
+
+# Funciones de los módulos opcionales del post-proceso (None si no se pudieron importar)
+_subir_a_minio: Optional[Callable[..., dict]] = None
+_enviar_por_correo: Optional[Callable[..., bool]] = None
+
+
+def cargar_modulos_post_proceso():
+    """
+    Importa los módulos opcionales del post-proceso (MinIO y correo)
+
+    Se llama al inicio para advertir antes de horas de auditoría; el resultado
+    queda en _subir_a_minio / _enviar_por_correo y el final omite lo que falte.
+    """
+    global _subir_a_minio, _enviar_por_correo
+
+    try:
+        from minio_client import upload_auditoria_files
+        _subir_a_minio = upload_auditoria_files
+    except ImportError as e:
+        logger.warning(f"Módulo minio_client no disponible ({e}): se omitirá la subida a MinIO al finalizar")
+
+    try:
+        from email_sender import enviar_reporte_por_correo
+        _enviar_por_correo = enviar_reporte_por_correo
+    except ImportError as e:
+        logger.warning(f"Módulo email_sender no disponible ({e}): se omitirá el envío de correo al finalizar")
+
+
+def subir_archivos_minio(artefactos: Dict[str, Optional[str]], timestamp: str) -> dict:
+    """
+    Sube los artefactos de la corrida a MinIO (carpeta YYYYMMDD)
+
+    Requiere cargar_modulos_post_proceso(); las excepciones se propagan al llamador.
+
+    Returns:
+        Diccionario con resultados: {"exitosos": [...], "fallidos": [...]}
+    """
+    # Extraer fecha del timestamp para organizar en carpetas (formato YYYYMMDD)
+    fecha_carpeta = timestamp.split('_')[0]  # Extrae "20251114" de "20251114_153045"
+
+    # Subir archivos
+    return _subir_a_minio(**artefactos, fecha_carpeta=fecha_carpeta)
+
+
+def objeto_html_subido(futuro_minio, html_path: Optional[str], timestamp: str) -> Optional[str]:
+    """
+    Espera la subida a MinIO y devuelve el nombre del objeto del reporte HTML
+
+    Returns:
+        Nombre del objeto, o None si el HTML no se subió (o la subida falló)
+    """
+    if html_path is None:
+        return None
+    try:
+        results = futuro_minio.result()
+    except Exception:
+        return None
+    if html_path not in results["exitosos"]:
+        return None
+    return f"{timestamp.split('_')[0]}/{os.path.basename(html_path)}"
+
+
+def enviar_reporte_correo(
+    artefactos: Dict[str, Optional[str]],
+    timestamp: str,
+    objeto_minio: Optional[Callable[[], Optional[str]]] = None,
+    corrida_incompleta: bool = False
+) -> bool:
+    """
+    Envía el reporte de la corrida por correo electrónico
+
+    Si el HTML es muy grande para adjuntarlo, el enlace apunta al objeto que ya
+    subió la corrida (objeto_minio) en lugar de subirlo de nuevo. Con
+    corrida_incompleta el correo se envía como alerta (aunque no haya HTML).
+
+    Requiere cargar_modulos_post_proceso(); las excepciones se propagan al llamador.
+
+    Returns:
+        True si el correo se envió
+    """
+    # Extraer fecha para el asunto del correo
+    fecha_reporte = INICIO_CORRIDA.strftime("%Y-%m-%d")
+
+    # Misma carpeta YYYYMMDD que la subida de la corrida (si el HTML va como enlace)
+    minio_prefix = timestamp.split('_')[0] + '/'
+
+    # Enviar correo
+    return _enviar_por_correo(
+        **artefactos, fecha_reporte=fecha_reporte, minio_prefix=minio_prefix,
+        objeto_minio=objeto_minio, corrida_incompleta=corrida_incompleta
+    )
 
 
 # --- Punto de Entrada ---
 if __name__ == "__main__":
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    timestamp = INICIO_CORRIDA.strftime("%Y%m%d_%H%M%S")
 
     # Asegurar carpetas
     os.makedirs("output", exist_ok=True)
@@ -696,118 +1462,116 @@ if __name__ == "__main__":
 
     # Archivos de salida
     output_jsonl = os.path.join("output", f"auditoria_urgencias_{timestamp}.jsonl")
-    state_file = os.path.join("output", f"tracking_{timestamp}.json")
+    state_file = os.path.join("output", f"tracking_{timestamp}.jsonl")
 
     logger.info(f"\nARCHIVOS DE SALIDA:")
     logger.info(f"  - JSONL: {output_jsonl}")
     logger.info(f"  - Estado: {state_file}")
 
+    # Módulos opcionales del post-proceso: se importan al inicio para advertir
+    # antes de horas de auditoría
+    cargar_modulos_post_proceso()
+
     # Ejecutar auditoría
     orquestador = OrquestadorAuditoriaProduccion(
         output_file=output_jsonl,
         state_file=state_file
     )
 
-    orquestador.run_auditoria_24h()
+    # Una corrida incompleta igual genera reporte, sube logs/tracking y avisa por correo
+    corrida_completa = orquestador.run_auditoria_24h()
 
-    # Generar reporte HTML automáticamente
+    # Generar reporte HTML automáticamente (en el mismo proceso, sin lanzar otro intérprete)
     logger.info("\nGENERANDO REPORTE HTML...")
-    import subprocess
 
     try:
-        result = subprocess.run(
-            ["python", "generar_reporte.py", output_jsonl],
-            capture_output=True,
-            text=True
-        )
+        from generar_reporte import generar_reporte_html
 
-        if result.returncode == 0:
-            output_html = output_jsonl.replace('.jsonl', '.html')
-            logger.info(f"Reporte HTML generado: {output_html}")
-        else:
-            logger.warning(f"Error al generar reporte HTML: {result.stderr}")
-            logger.info(f"Puedes generarlo manualmente: python generar_reporte.py {output_jsonl}")
+        output_html, _ = generar_reporte_html(output_jsonl)
+        logger.info(f"Reporte HTML generado: {output_html}")
 
     except Exception as e:
         logger.warning(f"No se pudo generar reporte HTML automáticamente: {e}")
         logger.info(f"Puedes generarlo manualmente: python generar_reporte.py {output_jsonl}")
 
-    # Subir archivos a MinIO
+    # MinIO y correo usan servicios distintos: se ejecutan en paralelo y sus
+    # logs y resultados se registran después, agrupados y en el orden de siempre
     logger.info("\n" + "="*80)
-    logger.info("SUBIENDO ARCHIVOS A MINIO")
+    logger.info("SUBIENDO ARCHIVOS A MINIO Y ENVIANDO REPORTE POR CORREO")
     logger.info("="*80)
+    flush_logs()
+
+    # Mismas rutas para ambos destinos, calculadas una sola vez
+    artefactos = artefactos_corrida(output_jsonl, state_file)
+
+    agrupador_logs = _AgrupadorLogs("minio_client", "email_sender")
+    _encolador.addFilter(agrupador_logs)
+
+    futuro_minio = futuro_correo = None
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        if _subir_a_minio is not None:
+            futuro_minio = executor.submit(subir_archivos_minio, artefactos, timestamp)
+        if _enviar_por_correo is not None:
+            # Un reporte grande se envía como enlace al mismo objeto que sube MinIO
+            # (el correo solo espera esa subida si necesita el enlace)
+            objeto_minio = None
+            if futuro_minio is not None:
+                objeto_minio = partial(objeto_html_subido, futuro_minio, artefactos["html_path"], timestamp)
+            futuro_correo = executor.submit(
+                enviar_reporte_correo, artefactos, timestamp, objeto_minio, not corrida_completa
+            )
 
-    try:
-        from minio_client import upload_auditoria_files
-
-        # Determinar archivo HTML
-        output_html = output_jsonl.replace('.jsonl', '.html')
-
-        # Determinar archivo de log
-        log_filename = f"logs/auditoria_{datetime.now():%Y%m%d}.log"
-
-        # Extraer fecha del timestamp para organizar en carpetas (formato YYYYMMDD)
-        fecha_carpeta = timestamp.split('_')[0]  # Extrae "20251114" de "20251114_153045"
+    # Resultados de MinIO
+    logger.info("\n" + "="*80)
+    logger.info("SUBIDA DE ARCHIVOS A MINIO")
+    logger.info("="*80)
+    agrupador_logs.emitir("minio_client")
 
-        # Subir archivos
-        results = upload_auditoria_files(
-            jsonl_path=output_jsonl,
-            html_path=output_html if os.path.exists(output_html) else None,
-            tracking_path=state_file,
-            log_path=log_filename if os.path.exists(log_filename) else None,
-            fecha_carpeta=fecha_carpeta
-        )
+    if futuro_minio is None:
+        logger.warning("Módulo minio_client no disponible. Saltando subida a MinIO.")
+        logger.info("Para habilitar MinIO: pip install minio y configurar variables en .env")
+    else:
+        try:
+            results = futuro_minio.result()
 
-        # Mostrar resultados
-        if results["exitosos"]:
-            logger.info(f"Archivos subidos exitosamente a MinIO: {len(results['exitosos'])}")
-            for archivo in results["exitosos"]:
-                logger.info(f"  - {os.path.basename(archivo)}")
+            # Mostrar resultados
+            if results["exitosos"]:
+                logger.info(f"Archivos subidos exitosamente a MinIO: {len(results['exitosos'])}")
+                for archivo in results["exitosos"]:
+                    logger.info(f"  - {os.path.basename(archivo)}")
 
-        if results["fallidos"]:
-            logger.warning(f"Archivos que no se pudieron subir: {len(results['fallidos'])}")
-            for archivo in results["fallidos"]:
-                logger.warning(f"  - {os.path.basename(archivo)}")
+            if results["fallidos"]:
+                logger.warning(f"Archivos que no se pudieron subir: {len(results['fallidos'])}")
+                for archivo in results["fallidos"]:
+                    logger.warning(f"  - {os.path.basename(archivo)}")
 
-    except ImportError:
-        logger.warning("Módulo minio_client no disponible. Saltando subida a MinIO.")
-        logger.info("Para habilitar MinIO: pip install minio y configurar variables en .env")
-    except Exception as e:
-        logger.error(f"Error al subir archivos a MinIO: {e}")
-        logger.info("Los archivos están disponibles localmente en la carpeta output/")
+        except Exception as e:
+            logger.error(f"Error al subir archivos a MinIO: {e}")
+            logger.info("Los archivos están disponibles localmente en la carpeta output/")
 
-    # Enviar reporte por correo electrónico
+    # Resultado del correo
     logger.info("\n" + "="*80)
-    logger.info("ENVIANDO REPORTE POR CORREO ELECTRÓNICO")
+    logger.info("ENVÍO DE REPORTE POR CORREO ELECTRÓNICO")
     logger.info("="*80)
+    agrupador_logs.emitir("email_sender")
+    _encolador.removeFilter(agrupador_logs)
 
-    try:
-        from email_sender import enviar_reporte_por_correo
-
-        # Determinar archivos
-        output_html = output_jsonl.replace('.jsonl', '.html')
-        log_filename = f"logs/auditoria_{datetime.now():%Y%m%d}.log"
-
-        # Extraer fecha para el asunto del correo
-        fecha_reporte = datetime.now().strftime("%Y-%m-%d")
+    if futuro_correo is None:
+        logger.warning("Módulo email_sender no disponible. Saltando envío de correo.")
+        logger.info("El módulo email_sender.py debe estar en el directorio del proyecto")
+    else:
+        try:
+            enviado = futuro_correo.result()
 
-        # Enviar correo
-        enviado = enviar_reporte_por_correo(
-            jsonl_path=output_jsonl if os.path.exists(output_jsonl) else None,
-            html_path=output_html if os.path.exists(output_html) else None,
-            tracking_path=state_file if os.path.exists(state_file) else None,
-            log_path=log_filename if os.path.exists(log_filename) else None,
-            fecha_reporte=fecha_reporte
-        )
+            if enviado:
+                logger.info("Reporte enviado por correo exitosamente")
+            else:
+                logger.warning("No se pudo enviar el correo (ver logs para detalles)")
 
-        if enviado:
-            logger.info("Reporte enviado por correo exitosamente")
-        else:
-            logger.warning("No se pudo enviar el correo (ver logs para detalles)")
+        except Exception as e:
+            logger.error(f"Error al enviar correo: {e}")
+            logger.info("Los archivos están disponibles localmente en la carpeta output/")
 
-    except ImportError:
-        logger.warning("Módulo email_sender no disponible. Saltando envío de correo.")
-        logger.info("El módulo email_sender.py debe estar en el directorio del proyecto")
-    except Exception as e:
-        logger.error(f"Error al enviar correo: {e}")
-        logger.info("Los archivos están disponibles localmente en la carpeta output/")
+    # Código de salida distinto de cero para que el scheduler registre la corrida incompleta
+    if not corrida_completa:
+        sys.exit(1)
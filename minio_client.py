@@ -4,18 +4,68 @@ Permite subir archivos de auditoría (JSONL, HTML, JSON, logs) a MinIO
 """
 
 import os
+import gzip
+import json
+import shutil
 import logging
+import tempfile
+import threading
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Optional, List
+from itertools import islice
+from typing import Iterator, Optional, List
+import certifi
+import urllib3
 from minio import Minio
+from minio.commonconfig import CopySource
 from minio.error import S3Error
 from dotenv import load_dotenv
+from utils.archivos import rutas_existentes
 
 # Cargar variables de entorno
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
+# Multipart para archivos grandes: partes de 64 MiB subidas en paralelo.
+# Con partes pequeñas el overhead por parte domina y el throughput cae mucho;
+# por debajo del umbral se deja part_size=0 (minio-py elige el tamaño).
+MULTIPART_UMBRAL_BYTES = 256 * 1024 * 1024
+MULTIPART_PART_SIZE = 64 * 1024 * 1024
+MULTIPART_PARALELO = 4
+
+# Pool HTTP: hasta 8 subidas simultáneas × MULTIPART_PARALELO partes cada una.
+# El pool por defecto de minio-py (10 conexiones) las serializaría
+POOL_HTTP_MAX_CONEXIONES = 32
+# Lectura generosa: la respuesta a una parte de 64 MiB puede demorar
+TIMEOUT_HTTP = urllib3.Timeout(connect=5, read=300)
+
+# Artefactos de texto que se suben comprimidos con gzip (Content-Encoding: gzip).
+# El nombre del objeto no cambia: navegadores y clientes HTTP descomprimen solos
+COMPRESION_GZIP_NIVEL = 1
+EXTENSIONES_COMPRIMIBLES = frozenset({"html", "json", "jsonl", "log", "txt", "csv"})
+# Hasta este tamaño el gzip se arma en memoria; por encima va a un archivo temporal
+COMPRESION_MEMORIA_MAX_BYTES = 16 * 1024 * 1024
+
+# Content type por extensión (sin el punto)
+_CONTENT_TYPES = {
+    "html": "text/html",
+    "json": "application/json",
+    "jsonl": "application/jsonl",
+    "log": "text/plain",
+    "txt": "text/plain",
+    "pdf": "application/pdf",
+    "csv": "text/csv"
+}
+
+
+def _normalizar_prefijo(prefix: Optional[str]) -> str:
+    """Devuelve el prefijo terminado en '/' (o '' si no hay prefijo)"""
+    if not prefix:
+        return ""
+    return prefix if prefix.endswith('/') else prefix + '/'
+
 
 class MinIOClient:
     """Cliente para interactuar con MinIO y almacenar archivos de auditoría de urgencias"""
@@ -29,6 +79,13 @@ class MinIOClient:
         self.bucket_name = os.getenv("MINIO_BUCKET_NAME", "auditoria-urgencias")
         self.use_ssl = os.getenv("MINIO_USE_SSL", "false").lower() == "true"
 
+        # Caché local de subidas, una entrada por archivo local:
+        # {ruta: {"firma": [...], "bucket": ..., "objeto": ..., "etag": ...}}
+        self.upload_cache_path = os.getenv("MINIO_UPLOAD_CACHE", "output/.minio_upload_cache.json")
+        self._cache_subidas = self._cargar_cache_subidas()
+        self._cache_modificada = False
+        self._lock_cache = threading.Lock()
+
         # Validar credenciales
         if not self.access_key or not self.secret_key:
             raise ValueError(
@@ -41,7 +98,8 @@ class MinIOClient:
                 endpoint=self.endpoint,
                 access_key=self.access_key,
                 secret_key=self.secret_key,
-                secure=self.use_ssl
+                secure=self.use_ssl,
+                http_client=self._crear_pool_http()
             )
             logger.info(f"Cliente MinIO inicializado: {self.endpoint}")
 
@@ -52,6 +110,89 @@ class MinIOClient:
             logger.error(f"Error al inicializar cliente MinIO: {e}")
             raise
 
+    @staticmethod
+    def _crear_pool_http() -> urllib3.PoolManager:
+        """Pool HTTP keep-alive dimensionado para las subidas en paralelo (mismos reintentos y CA que minio-py)"""
+        return urllib3.PoolManager(
+            num_pools=4,
+            maxsize=POOL_HTTP_MAX_CONEXIONES,
+            block=False,
+            timeout=TIMEOUT_HTTP,
+            cert_reqs="CERT_REQUIRED",
+            ca_certs=os.environ.get("SSL_CERT_FILE") or certifi.where(),
+            retries=urllib3.Retry(
+                total=3,
+                backoff_factor=0.2,
+                status_forcelist=[500, 502, 503, 504]
+            )
+        )
+
+    def _cargar_cache_subidas(self) -> dict:
+        """Carga la caché de subidas (vacía si no existe o está corrupta)"""
+        try:
+            with open(self.upload_cache_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logger.warning(f"Caché de subidas ilegible, se ignora: {e}")
+            return {}
+
+    def _objeto_sin_cambios(self, file_path: str, firma: list) -> Optional[str]:
+        """
+        Devuelve el objeto remoto que ya tiene esta misma versión del archivo (o None)
+
+        La firma local (tamaño, mtime, gzip) debe coincidir con la de la última
+        subida del archivo y el ETag remoto (un HEAD) con el que devolvió esa subida.
+        """
+        entrada = self._cache_subidas.get(file_path)
+        if (
+            not isinstance(entrada, dict)
+            or entrada.get("firma") != firma
+            or entrada.get("bucket") != self.bucket_name
+        ):
+            return None
+        try:
+            objeto = self.client.stat_object(self.bucket_name, entrada["objeto"])
+        except S3Error:
+            return None
+        return entrada["objeto"] if objeto.etag == entrada["etag"] else None
+
+    def _registrar_subida(self, file_path: str, firma: list, object_name: str, etag: Optional[str]):
+        """Anota en memoria la firma, el objeto y el ETag de una subida (ver _guardar_cache_subidas)"""
+        if not etag:
+            return
+        with self._lock_cache:
+            self._cache_subidas[file_path] = {
+                "firma": firma, "bucket": self.bucket_name, "objeto": object_name, "etag": etag
+            }
+            self._cache_modificada = True
+
+    def _guardar_cache_subidas(self):
+        """
+        Persiste la caché de subidas (escritura atómica, una vez por carga)
+
+        Descarta las entradas de archivos locales que ya no existen y las de
+        formatos anteriores, para que el archivo no crezca sin límite.
+        """
+        with self._lock_cache:
+            if not self._cache_modificada:
+                return
+            existentes = rutas_existentes(*self._cache_subidas)
+            self._cache_subidas = {
+                ruta: entrada for ruta, entrada in self._cache_subidas.items()
+                if ruta in existentes and isinstance(entrada, dict) and "objeto" in entrada
+            }
+            try:
+                directorio = os.path.dirname(self.upload_cache_path) or "."
+                os.makedirs(directorio, exist_ok=True)
+                with tempfile.NamedTemporaryFile('w', dir=directorio, delete=False, encoding='utf-8') as tmp:
+                    json.dump(self._cache_subidas, tmp)
+                os.replace(tmp.name, self.upload_cache_path)
+                self._cache_modificada = False
+            except OSError as e:
+                logger.warning(f"No se pudo guardar la caché de subidas: {e}")
+
     def _ensure_bucket_exists(self):
         """Verifica que el bucket exista, si no lo crea"""
         try:
@@ -70,7 +211,9 @@ class MinIOClient:
         file_path: str,
         object_name: Optional[str] = None,
         metadata: Optional[dict] = None,
-        prefix: Optional[str] = None
+        prefix: Optional[str] = None,
+        comprimir: bool = False,
+        upload_date: Optional[str] = None
     ) -> bool:
         """
         Sube un archivo a MinIO
@@ -80,55 +223,110 @@ class MinIOClient:
             object_name: Nombre del objeto en MinIO (si None, usa nombre del archivo)
             metadata: Metadatos adicionales para el archivo
             prefix: Prefijo/carpeta para organizar archivos (ej: "20251114/")
+            comprimir: Subir con gzip (Content-Encoding) si es un archivo de texto
+            upload_date: Fecha ISO para la metadata (si None, el instante actual)
 
         Returns:
             True si se subió exitosamente, False en caso contrario
         """
-        if not os.path.exists(file_path):
-            logger.error(f"Archivo no encontrado: {file_path}")
-            return False
-
         # Si no se especifica object_name, usar nombre del archivo
         if object_name is None:
             object_name = os.path.basename(file_path)
 
         # Agregar prefijo si se especifica (para organizar en carpetas)
-        if prefix:
-            # Asegurar que el prefijo termine con /
-            if not prefix.endswith('/'):
-                prefix += '/'
-            object_name = prefix + object_name
-
-        try:
-            # Obtener tamaño del archivo
-            file_size = os.path.getsize(file_path)
+        object_name = _normalizar_prefijo(prefix) + object_name
 
-            # Determinar content type basado en extensión
-            content_type = self._get_content_type(file_path)
+        subido = self._subir_objeto(file_path, object_name, metadata, comprimir, upload_date)
+        self._guardar_cache_subidas()
+        return subido
 
-            # Agregar metadata default
-            if metadata is None:
-                metadata = {}
-
-            metadata.update({
-                "upload_date": datetime.now().isoformat(),
-                "original_path": file_path,
-                "file_size": str(file_size)
-            })
+    def _subir_objeto(
+        self,
+        file_path: str,
+        object_name: str,
+        metadata: Optional[dict],
+        comprimir: bool,
+        upload_date: Optional[str]
+    ) -> bool:
+        """
+        Sube file_path como object_name (nombre final, con el prefijo ya aplicado)
 
-            # Subir archivo
-            logger.info(f"Subiendo archivo a MinIO: {file_path} -> {object_name}")
-            self.client.fput_object(
-                bucket_name=self.bucket_name,
-                object_name=object_name,
-                file_path=file_path,
-                content_type=content_type,
-                metadata=metadata
-            )
+        La caché queda actualizada solo en memoria: el llamador la persiste con
+        _guardar_cache_subidas al terminar la carga.
+        """
+        comprimir = comprimir and file_path.rpartition('.')[2].lower() in EXTENSIONES_COMPRIMIBLES
 
-            logger.info(f"Archivo subido exitosamente: {object_name} ({file_size} bytes)")
+        try:
+            # Un solo open + fstat; fput_object volvería a hacer stat y abrir el archivo
+            with open(file_path, 'rb', buffering=1 << 20) as f:
+                # El mismo stat da tamaño y fecha de modificación para la metadata
+                estado = os.fstat(f.fileno())
+                file_size = estado.st_size
+
+                # Archivo sin cambios desde su última subida: no se vuelve a leer ni enviar
+                firma = [file_size, estado.st_mtime_ns, comprimir]
+                objeto_previo = self._objeto_sin_cambios(file_path, firma)
+                if objeto_previo == object_name:
+                    logger.info(f"Archivo sin cambios en MinIO, se omite la subida: {object_name}")
+                    return True
+                if objeto_previo is not None:
+                    # Subido antes con otro nombre (la carpeta de otro día): copia en el servidor
+                    try:
+                        resultado = self.client.copy_object(
+                            self.bucket_name, object_name, CopySource(self.bucket_name, objeto_previo)
+                        )
+                        self._registrar_subida(file_path, firma, object_name, resultado.etag)
+                        logger.info(f"Archivo sin cambios, copiado en MinIO desde {objeto_previo}: {object_name}")
+                        return True
+                    except S3Error as e:
+                        logger.warning(f"No se pudo copiar {objeto_previo} en MinIO, se sube de nuevo: {e}")
+
+                # Determinar content type basado en extensión
+                content_type = self._get_content_type(file_path)
+
+                # Agregar metadata default (en un dict nuevo: no se modifica el del llamador)
+                metadata = {
+                    **(metadata or {}),
+                    "upload_date": upload_date or datetime.now().isoformat(),
+                    "original_path": file_path,
+                    "file_size": str(file_size),
+                    "file_mtime": datetime.fromtimestamp(estado.st_mtime).isoformat()
+                }
+                if comprimir:
+                    metadata["Content-Encoding"] = "gzip"
+
+                with (self._comprimir_gzip(f) if comprimir else nullcontext(f)) as data:
+                    # Tamaño de lo que realmente se envía
+                    length = data.tell() if comprimir else file_size
+                    data.seek(0)
+
+                    # Partes grandes solo cuando el archivo lo justifica
+                    part_size = MULTIPART_PART_SIZE if length > MULTIPART_UMBRAL_BYTES else 0
+
+                    # Subir archivo
+                    logger.info(f"Subiendo archivo a MinIO: {file_path} -> {object_name}")
+                    resultado = self.client.put_object(
+                        bucket_name=self.bucket_name,
+                        object_name=object_name,
+                        data=data,
+                        length=length,
+                        content_type=content_type,
+                        metadata=metadata,
+                        part_size=part_size,
+                        num_parallel_uploads=MULTIPART_PARALELO
+                    )
+
+            self._registrar_subida(file_path, firma, object_name, resultado.etag)
+
+            if comprimir:
+                logger.info(f"Archivo subido exitosamente: {object_name} ({file_size} bytes, {length} con gzip)")
+            else:
+                logger.info(f"Archivo subido exitosamente: {object_name} ({file_size} bytes)")
             return True
 
+        except FileNotFoundError:
+            logger.error(f"Archivo no encontrado: {file_path}")
+            return False
         except S3Error as e:
             logger.error(f"Error al subir archivo a MinIO: {e}")
             return False
@@ -136,13 +334,29 @@ class MinIOClient:
             logger.error(f"Error inesperado al subir archivo: {e}")
             return False
 
-    def upload_multiple_files(self, file_paths: List[str], prefix: Optional[str] = None) -> dict:
+    @staticmethod
+    def _comprimir_gzip(f) -> tempfile.SpooledTemporaryFile:
+        """Comprime el contenido de f con gzip; devuelve el resultado posicionado al final"""
+        comprimido = tempfile.SpooledTemporaryFile(max_size=COMPRESION_MEMORIA_MAX_BYTES)
+        with gzip.GzipFile(fileobj=comprimido, mode='wb', compresslevel=COMPRESION_GZIP_NIVEL) as gz:
+            shutil.copyfileobj(f, gz, 1 << 20)
+        return comprimido
+
+    def upload_multiple_files(
+        self,
+        file_paths: List[str],
+        prefix: Optional[str] = None,
+        max_workers: int = 8,
+        comprimir: bool = False
+    ) -> dict:
         """
-        Sube múltiples archivos a MinIO
+        Sube múltiples archivos a MinIO en paralelo (el cliente Minio es thread-safe)
 
         Args:
             file_paths: Lista de rutas de archivos a subir
             prefix: Prefijo/carpeta para organizar archivos (ej: "20251114/")
+            max_workers: Máximo de subidas simultáneas
+            comprimir: Subir los archivos de texto con gzip (ver upload_file)
 
         Returns:
             Diccionario con resultados: {"exitosos": [...], "fallidos": [...]}
@@ -152,9 +366,28 @@ class MinIOClient:
             "fallidos": []
         }
 
-        for file_path in file_paths:
-            success = self.upload_file(file_path, prefix=prefix)
-            if success:
+        if not file_paths:
+            return results
+
+        # Misma fecha de carga y prefijo normalizado una sola vez para todo el lote
+        upload_date = datetime.now().isoformat()
+        prefijo = _normalizar_prefijo(prefix)
+
+        # Las subidas se solapan; los resultados se recogen en el orden de entrada
+        with ThreadPoolExecutor(max_workers=min(len(file_paths), max_workers)) as executor:
+            futures = [
+                executor.submit(
+                    self._subir_objeto, file_path, prefijo + os.path.basename(file_path),
+                    None, comprimir, upload_date
+                )
+                for file_path in file_paths
+            ]
+
+        # Una sola escritura de la caché por lote
+        self._guardar_cache_subidas()
+
+        for file_path, future in zip(file_paths, futures):
+            if future.result():
                 results["exitosos"].append(file_path)
             else:
                 results["fallidos"].append(file_path)
@@ -167,31 +400,21 @@ class MinIOClient:
 
         return results
 
-    def _get_content_type(self, file_path: str) -> str:
+    @staticmethod
+    def _get_content_type(file_path: str) -> str:
         """Determina el content type basado en la extensión del archivo"""
-        extension = os.path.splitext(file_path)[1].lower()
-
-        content_types = {
-            ".html": "text/html",
-            ".json": "application/json",
-            ".jsonl": "application/jsonl",
-            ".log": "text/plain",
-            ".txt": "text/plain",
-            ".pdf": "application/pdf",
-            ".csv": "text/csv"
-        }
+        return _CONTENT_TYPES.get(file_path.rpartition('.')[2].lower(), "application/octet-stream")
 
-        return content_types.get(extension, "application/octet-stream")
-
-    def list_files(self, prefix: Optional[str] = None) -> List[str]:
+    def list_files(self, prefix: Optional[str] = None, limit: Optional[int] = None) -> Iterator[str]:
         """
-        Lista archivos en el bucket
+        Lista archivos en el bucket (en streaming, página a página)
 
         Args:
             prefix: Prefijo para filtrar archivos (opcional)
+            limit: Máximo de nombres a devolver (None = todos)
 
         Returns:
-            Lista de nombres de archivos
+            Iterador de nombres de archivos (vacío si hay error)
         """
         try:
             objects = self.client.list_objects(
@@ -200,13 +423,11 @@ class MinIOClient:
                 recursive=True
             )
 
-            file_list = [obj.object_name for obj in objects]
-            logger.info(f"Archivos encontrados: {len(file_list)}")
-            return file_list
+            for object_name in islice((obj.object_name for obj in objects), limit):
+                yield object_name
 
         except S3Error as e:
             logger.error(f"Error al listar archivos: {e}")
-            return []
 
     def get_file_url(self, object_name: str, expires_hours: int = 24) -> Optional[str]:
         """
@@ -234,6 +455,26 @@ class MinIOClient:
 
 # --- Función Helper para uso fácil ---
 
+_cliente_compartido: Optional[MinIOClient] = None
+_lock_cliente = threading.Lock()
+
+
+def get_minio_client() -> MinIOClient:
+    """
+    Devuelve el cliente MinIO compartido del proceso (creado en la primera llamada)
+
+    Evita repetir por llamada el HEAD de bucket_exists y el pool HTTP nuevo. La
+    creación va bajo un lock: la subida y el correo del post-proceso corren en
+    hilos a la vez y, sin él, ambos podrían crear su propio cliente. Si la
+    creación falla no queda nada guardado y la siguiente llamada lo reintenta.
+    """
+    global _cliente_compartido
+    with _lock_cliente:
+        if _cliente_compartido is None:
+            _cliente_compartido = MinIOClient()
+        return _cliente_compartido
+
+
 def upload_auditoria_files(
     jsonl_path: Optional[str] = None,
     html_path: Optional[str] = None,
@@ -255,17 +496,12 @@ def upload_auditoria_files(
         Diccionario con resultados de carga
     """
     try:
-        minio_client = MinIOClient()
-
-        files_to_upload = []
-        if jsonl_path and os.path.exists(jsonl_path):
-            files_to_upload.append(jsonl_path)
-        if html_path and os.path.exists(html_path):
-            files_to_upload.append(html_path)
-        if tracking_path and os.path.exists(tracking_path):
-            files_to_upload.append(tracking_path)
-        if log_path and os.path.exists(log_path):
-            files_to_upload.append(log_path)
+        minio_client = get_minio_client()
+
+        # Un scandir por carpeta en vez de un stat por archivo
+        candidatos = (jsonl_path, html_path, tracking_path, log_path)
+        existentes = rutas_existentes(*candidatos)
+        files_to_upload = [path for path in candidatos if path in existentes]
 
         if not files_to_upload:
             logger.warning("No hay archivos para subir a MinIO")
@@ -277,7 +513,8 @@ def upload_auditoria_files(
         if prefix:
             logger.info(f"Organizando archivos en MinIO bajo la carpeta: {prefix}")
 
-        results = minio_client.upload_multiple_files(files_to_upload, prefix=prefix)
+        # JSONL, HTML y logs son texto muy repetitivo: se suben comprimidos
+        results = minio_client.upload_multiple_files(files_to_upload, prefix=prefix, comprimir=True)
         return results
 
     except Exception as e:
@@ -301,9 +538,9 @@ if __name__ == "__main__":
 
         # Listar archivos
         print("\nArchivos en bucket:")
-        files = client.list_files()
+        files = list(client.list_files(limit=10))  # Mostrar máximo 10
         if files:
-            for f in files[:10]:  # Mostrar máximo 10
+            for f in files:
                 print(f"  - {f}")
         else:
             print("  (bucket vacío)")
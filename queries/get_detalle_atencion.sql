@@ -4,21 +4,21 @@
 -- Obtiene TODA la información relacionada a una atención específica de emergencia
 -- incluyendo triage, evoluciones, medicamentos, ejecuciones, notas, labs, imágenes
 --
--- Parámetros:
---   {persona_numero} - ID del paciente
---   {cuenta_gestion} - Año de gestión de la cuenta
---   {cuenta_internacion} - Número de internación
---   {cuenta_id} - ID de la cuenta
+-- Parámetros (pymysql, placeholders con nombre; los valores se escapan en el driver):
+--   %(persona_numero)s - ID del paciente
+--   %(cuenta_gestion)s - Año de gestión de la cuenta
+--   %(cuenta_internacion)s - Número de internación
+--   %(cuenta_id)s - ID de la cuenta
 -- ============================================================================
 
 SELECT
     -- ========================================================================
     -- INFORMACIÓN BÁSICA DE LA CUENTA
     -- ========================================================================
-    '{persona_numero}' AS persona_numero,
-    '{cuenta_gestion}' AS cuenta_gestion,
-    '{cuenta_internacion}' AS cuenta_internacion,
-    '{cuenta_id}' AS cuenta_id,
+    %(persona_numero)s AS persona_numero,
+    %(cuenta_gestion)s AS cuenta_gestion,
+    %(cuenta_internacion)s AS cuenta_internacion,
+    %(cuenta_id)s AS cuenta_id,
 
     -- ========================================================================
     -- 1. INFORMACIÓN DE TRIAGE (TEMPORAL: comentado para testing)
@@ -97,6 +97,7 @@ SELECT
                 'causa_egreso', evo.PacienteEvolucionCausaEgre,
                 'complicaciones', evo.PacienteEvolucionCompliTexto
             )
+            ORDER BY evo.PacienteEvolucionFechaHora ASC
             SEPARATOR '\n---EVOLUCION---\n'
         )
         FROM pacienteevolucion evo
@@ -104,10 +105,9 @@ SELECT
         LEFT JOIN persona pers ON pers.PersonaNumero = usr.UsuarioPersonaCodigo
         LEFT JOIN clinica01.tiposaltas ta ON ta.CodTipoAlta = evo.taCodTipoAlta
         WHERE evo.PacienteEvolucionBFecha = '1000-01-01 00:00:00'
-          AND evo.PacienteEvolucionGestion = {cuenta_gestion}
-          AND evo.PacienteEvolucionNroInter = {cuenta_internacion}
-          AND evo.PacienteEvolucionNroIntId = {cuenta_id}
-        ORDER BY evo.PacienteEvolucionFechaHora ASC
+          AND evo.PacienteEvolucionGestion = %(cuenta_gestion)s
+          AND evo.PacienteEvolucionNroInter = %(cuenta_internacion)s
+          AND evo.PacienteEvolucionNroIntId = %(cuenta_id)s
     ) AS evoluciones_clinicas,
 
     -- ========================================================================
@@ -116,14 +116,14 @@ SELECT
     (
         SELECT GROUP_CONCAT(
             CONCAT(fecha_registro, ': ', descripcion, ' = ', valor, ' ', COALESCE(unidad, ''))
+            ORDER BY fecha_registro ASC
             SEPARATOR ' | '
         )
         FROM vw_hc_signos_vitales
-        WHERE persona_numero = {persona_numero}
-          AND cuenta_gestion = {cuenta_gestion}
-          AND cuenta_internacion = {cuenta_internacion}
-          AND cuenta_id = {cuenta_id}
-        ORDER BY fecha_registro ASC
+        WHERE persona_numero = %(persona_numero)s
+          AND cuenta_gestion = %(cuenta_gestion)s
+          AND cuenta_internacion = %(cuenta_internacion)s
+          AND cuenta_id = %(cuenta_id)s
     ) AS signos_vitales,
 
     -- ========================================================================
@@ -139,6 +139,7 @@ SELECT
                 ' | Enfermera: ', mc.Usuario,
                 ' | Observación: ', COALESCE(mc.glosa, '')
             )
+            ORDER BY mc.FechaReg ASC
             SEPARATOR '\n'
         )
         FROM clinica01.medicamentosc mc
@@ -147,9 +148,8 @@ SELECT
             AND md.NroInternacion = mc.NroInternacion
             AND md.NroMedicamento = mc.NroMedicamento
         LEFT JOIN clinica01.ivarticulos ia ON ia.IvcodArticulo = md.IvCodArticulo
-        WHERE mc.Gestion = {cuenta_gestion}
-          AND mc.NroInternacion = {cuenta_internacion}
-        ORDER BY mc.FechaReg ASC
+        WHERE mc.Gestion = %(cuenta_gestion)s
+          AND mc.NroInternacion = %(cuenta_internacion)s
     ) AS ejecuciones_medicamentos,
 
     -- ========================================================================
@@ -162,14 +162,14 @@ SELECT
                 ' | Usuario: ', NotaEnfMUsuario,
                 ' | Nota: ', NotaEnfConclusion
             )
+            ORDER BY COALESCE(NotaEnfHoraRealizado, NotaEnfMFecha) ASC
             SEPARATOR '\n'
         )
         FROM notasenfermeria
-        WHERE PersonaNumero = {persona_numero}
-          AND InterGestion = {cuenta_gestion}
-          AND InterNroInternacion = {cuenta_internacion}
-          AND InterNroIntID = {cuenta_id}
-        ORDER BY COALESCE(NotaEnfHoraRealizado, NotaEnfMFecha) ASC
+        WHERE PersonaNumero = %(persona_numero)s
+          AND InterGestion = %(cuenta_gestion)s
+          AND InterNroInternacion = %(cuenta_internacion)s
+          AND InterNroIntID = %(cuenta_id)s
     ) AS notas_enfermeria,
 
     -- ========================================================================
@@ -184,14 +184,14 @@ SELECT
                 ' | Resultados: ', linea_detalle, ': ', resultado, ' ', COALESCE(unidad, ''),
                 ' (Ref: ', COALESCE(valor_referencia, 'N/A'), ')'
             )
+            ORDER BY fecha_orden ASC, linea_detalle ASC
             SEPARATOR '\n'
         )
         FROM vw_hc_resultados_laboratorio
-        WHERE persona_numero = {persona_numero}
-          AND cuenta_gestion = {cuenta_gestion}
-          AND cuenta_internacion = {cuenta_internacion}
-          AND cuenta_id = {cuenta_id}
-        ORDER BY fecha_orden ASC, linea_detalle ASC
+        WHERE persona_numero = %(persona_numero)s
+          AND cuenta_gestion = %(cuenta_gestion)s
+          AND cuenta_internacion = %(cuenta_internacion)s
+          AND cuenta_id = %(cuenta_id)s
     ) AS laboratorios,
 
     -- ========================================================================
@@ -207,16 +207,16 @@ SELECT
                 ' | Título: ', det.titulo,
                 ' | Hallazgos: ', det.descripcion
             )
+            ORDER BY enc.fecha_estudio ASC
             SEPARATOR '\n---IMAGEN---\n'
         )
         FROM vw_hc_resultados_imagenes_encabezado enc
         JOIN vw_hc_resultados_imagenes_detalle det
             ON det.solicitud_codigo = enc.solicitud_codigo
-        WHERE enc.persona_numero = {persona_numero}
-          AND enc.cuenta_gestion = {cuenta_gestion}
-          AND enc.cuenta_internacion = {cuenta_internacion}
-          AND enc.cuenta_id = {cuenta_id}
-        ORDER BY enc.fecha_estudio ASC
+        WHERE enc.persona_numero = %(persona_numero)s
+          AND enc.cuenta_gestion = %(cuenta_gestion)s
+          AND enc.cuenta_internacion = %(cuenta_internacion)s
+          AND enc.cuenta_id = %(cuenta_id)s
     ) AS estudios_imagen,
 
     -- ========================================================================
@@ -233,6 +233,7 @@ SELECT
                 ' | Fecha solicitud: ', maestro.PacienteSolicudLaboratorioSFec,
                 ' | Codigo: ', prod.CodProdCMF
             )
+            ORDER BY maestro.PacienteSolicudLaboratorioSFec ASC
             SEPARATOR '\n'
         )
         FROM pacientesolicudlaboratorio maestro
@@ -240,10 +241,9 @@ SELECT
             ON det.PacienteSolicudLaboratorioCodi = maestro.PacienteSolicudLaboratorioCodi
         INNER JOIN clinica01.productos prod
             ON prod.CodProdCMF = det.productosCodProdCMF
-        WHERE maestro.PacienteLaboCodigo = {persona_numero}
-          AND maestro.PacienteSolicudLaboratorioGest = {cuenta_gestion}
-          AND maestro.PacienteSolicudLaboratorioNroI = {cuenta_internacion}
-        ORDER BY maestro.PacienteSolicudLaboratorioSFec ASC
+        WHERE maestro.PacienteLaboCodigo = %(persona_numero)s
+          AND maestro.PacienteSolicudLaboratorioGest = %(cuenta_gestion)s
+          AND maestro.PacienteSolicudLaboratorioNroI = %(cuenta_internacion)s
     ) AS solicitudes_laboratorio,
 
     -- ========================================================================
@@ -262,6 +262,7 @@ SELECT
                 ' | Fecha solicitud: ', sol.PacienteSolicudEstudioSFecha,
                 ' | Codigo: ', prest.PrestacionCodigo
             )
+            ORDER BY sol.PacienteSolicudEstudioSFecha ASC
             SEPARATOR '\n'
         )
         FROM pacientesolicudestudio sol
@@ -269,11 +270,10 @@ SELECT
             ON prest.PrestacionCodigo = sol.PrestacionCodigo
         INNER JOIN turnoatencion ate
             ON ate.TurnoNumero = sol.TurnoNumero
-        WHERE sol.Pacienteimagencodigo = {persona_numero}
-          AND ate.InternacionesGestion = {cuenta_gestion}
-          AND ate.InternacionesNroInternacion = {cuenta_internacion}
-          AND ate.InternacionesNroIntId = {cuenta_id}
-        ORDER BY sol.PacienteSolicudEstudioSFecha ASC
+        WHERE sol.Pacienteimagencodigo = %(persona_numero)s
+          AND ate.InternacionesGestion = %(cuenta_gestion)s
+          AND ate.InternacionesNroInternacion = %(cuenta_internacion)s
+          AND ate.InternacionesNroIntId = %(cuenta_id)s
     ) AS solicitudes_imagen
 
 FROM DUAL;
\ No newline at end of file
@@ -0,0 +1,290 @@
+-- ============================================================================
+-- Query: Detalle completo de VARIAS atenciones de emergencia (consulta masiva)
+-- ============================================================================
+-- Misma información que get_detalle_atencion.sql, pero para un conjunto de
+-- atenciones en un solo round-trip: devuelve una fila por cuenta.
+-- IMPORTANTE: Mantener sincronizadas las columnas con get_detalle_atencion.sql
+--
+-- Parámetros (pymysql, placeholder posicional del IN final):
+--   claves - Tupla de tuplas (persona_numero, cuenta_gestion, cuenta_internacion, cuenta_id)
+--            pymysql la expande como ((p1, g1, i1, c1), (p2, g2, i2, c2), ...)
+--
+-- NOTA: No usar el carácter de porcentaje en comentarios ni literales de esta
+-- query; pymysql la interpola con el operador de formato de Python.
+-- ============================================================================
+
+SELECT
+    -- ========================================================================
+    -- INFORMACIÓN BÁSICA DE LA CUENTA
+    -- ========================================================================
+    k.persona_numero AS persona_numero,
+    k.cuenta_gestion AS cuenta_gestion,
+    k.cuenta_internacion AS cuenta_internacion,
+    k.cuenta_id AS cuenta_id,
+
+    -- ========================================================================
+    -- 1. INFORMACIÓN DE TRIAGE (TEMPORAL: comentado para testing)
+    -- ========================================================================
+    NULL AS triage_info,
+
+    -- ========================================================================
+    -- 2. EVOLUCIONES CLÍNICAS de esta cuenta
+    -- ========================================================================
+    (
+        SELECT GROUP_CONCAT(
+            JSON_OBJECT(
+                'id_evolucion', evo.EvolucionAutonumerico,
+                'fecha', evo.PacienteEvolucionFechaHora,
+                'profesional', pers.PersonaNombreCompleto,
+                'tipo_evento', CASE evo.PacienteEvolucionTipo
+                    WHEN 0 THEN 'Evaluación Inicial'
+                    WHEN 1 THEN 'Evaluación Inicial'
+                    WHEN 2 THEN 'Evolución'
+                    WHEN 3 THEN 'Epicrisis'
+                    WHEN 4 THEN 'Interconsulta'
+                    WHEN 5 THEN 'Reporte Enfermería'
+                    WHEN 23 THEN 'Evolución Enfermería'
+                    ELSE 'Evolución Clínica'
+                END,
+                'diagnosticos', (
+                    SELECT GROUP_CONCAT(
+                        CONCAT(diag.CIE9CMCodigo, '-', cie.CIE9CMDescripcion,
+                            CASE diag.PacienteEvolucionProblemaTipo
+                                WHEN 1 THEN ' (Principal)'
+                                WHEN 2 THEN ' (Secundario)'
+                                ELSE ''
+                            END
+                        ) SEPARATOR ' | '
+                    )
+                    FROM pacienteevoluciondiagnostico diag
+                    LEFT JOIN cie9cm cie ON cie.CIE9CMCodigo = diag.CIE9CMCodigo
+                    WHERE diag.PersonaNumero = evo.PersonaNumero
+                      AND diag.PacienteEvolucionFechaHora = evo.PacienteEvolucionFechaHora
+                ),
+                'comentario_clinico', CONCAT_WS('\n',
+                    NULLIF(evo.PacienteEvolucionSubjetivo, ''),
+                    NULLIF(evo.PacienteEvolucionObjetivo, ''),
+                    NULLIF(evo.PacienteEvolucionProblema, ''),
+                    NULLIF(evo.PacienteEvolucionComentario, ''),
+                    NULLIF(evo.PacienteEvolucionHallazgos, ''),
+                    NULLIF(evo.PacienteEvolucionEvFinal, '')  -- FIX v1.2.2: Evaluación final (epicrisis)
+                ),
+                'plan_medico', CONCAT_WS('\n',
+                    NULLIF(evo.PacienteEvolucionPlan, ''),
+                    NULLIF(evo.PacienteEvolucionPlanterapeuti, '')
+                ),
+                'medicamentos_prescritos', (
+                    SELECT GROUP_CONCAT(
+                        CONCAT_WS(' ',
+                            CONVERT(COALESCE(ivartmed.nombregenerico, art.IvDescrip) USING utf8mb4),
+                            CONVERT(COALESCE(med.PacienteMedicamentoDosisCombin, '') USING utf8mb4),
+                            CONVERT(COALESCE(med.UnidadCodigo, '') USING utf8mb4),
+                            CASE med.PacienteMedicamentoFrecUnidad
+                                WHEN 1 THEN CONCAT('cada ', med.PacienteMedicamentoFrecuencia, ' horas')
+                                WHEN 2 THEN CONCAT('cada ', med.PacienteMedicamentoFrecuencia, ' días')
+                                WHEN 3 THEN 'PRN'
+                                ELSE ''
+                            END,
+                            CONCAT('(', CONVERT(vias.Descripcion USING utf8mb4), ')')
+                        ) SEPARATOR ' | '
+                    )
+                    FROM pacienteevolucionmedicamento med
+                    LEFT JOIN clinica01.ivarticulosmed ivartmed ON ivartmed.ivcodarticulo = med.MedicamentoCodigo
+                    LEFT JOIN clinica01.ivarticulos art ON art.IvcodArticulo = med.MedicamentoCodigo
+                    LEFT JOIN clinica01.vias ON clinica01.vias.CodVia = med.ViaEvoCodigo
+                    WHERE med.PersonaNumero = evo.PersonaNumero
+                      AND med.PacienteEvolucionFechaHora = evo.PacienteEvolucionFechaHora
+                ),
+                'condicion_alta', CONVERT(ta.Descripcion USING utf8mb4),
+                'causa_egreso', evo.PacienteEvolucionCausaEgre,
+                'complicaciones', evo.PacienteEvolucionCompliTexto
+            )
+            ORDER BY evo.PacienteEvolucionFechaHora ASC
+            SEPARATOR '\n---EVOLUCION---\n'
+        )
+        FROM pacienteevolucion evo
+        LEFT JOIN usuario usr ON usr.UsuarioCodigo = evo.PacienteEvolucionMUsuario
+        LEFT JOIN persona pers ON pers.PersonaNumero = usr.UsuarioPersonaCodigo
+        LEFT JOIN clinica01.tiposaltas ta ON ta.CodTipoAlta = evo.taCodTipoAlta
+        WHERE evo.PacienteEvolucionBFecha = '1000-01-01 00:00:00'
+          AND evo.PacienteEvolucionGestion = k.cuenta_gestion
+          AND evo.PacienteEvolucionNroInter = k.cuenta_internacion
+          AND evo.PacienteEvolucionNroIntId = k.cuenta_id
+    ) AS evoluciones_clinicas,
+
+    -- ========================================================================
+    -- 3. SIGNOS VITALES de esta cuenta
+    -- ========================================================================
+    (
+        SELECT GROUP_CONCAT(
+            CONCAT(fecha_registro, ': ', descripcion, ' = ', valor, ' ', COALESCE(unidad, ''))
+            ORDER BY fecha_registro ASC
+            SEPARATOR ' | '
+        )
+        FROM vw_hc_signos_vitales
+        WHERE persona_numero = k.persona_numero
+          AND cuenta_gestion = k.cuenta_gestion
+          AND cuenta_internacion = k.cuenta_internacion
+          AND cuenta_id = k.cuenta_id
+    ) AS signos_vitales,
+
+    -- ========================================================================
+    -- 4. EJECUCIONES DE MEDICAMENTOS (desde clinica01)
+    -- ========================================================================
+    (
+        SELECT GROUP_CONCAT(
+            CONCAT(
+                'Fecha: ', mc.FechaReg,
+                ' | Medicamento: ', COALESCE(ia.IvDescrip, 'No especificado'),
+                ' | Cantidad: ', COALESCE(md.Cantidad, ''),
+                ' | Unidad: ', COALESCE(md.Unidad, ''),
+                ' | Enfermera: ', mc.Usuario,
+                ' | Observación: ', COALESCE(mc.glosa, '')
+            )
+            ORDER BY mc.FechaReg ASC
+            SEPARATOR '\n'
+        )
+        FROM clinica01.medicamentosc mc
+        LEFT JOIN clinica01.medicamentosd md
+            ON md.Gestion = mc.Gestion
+            AND md.NroInternacion = mc.NroInternacion
+            AND md.NroMedicamento = mc.NroMedicamento
+        LEFT JOIN clinica01.ivarticulos ia ON ia.IvcodArticulo = md.IvCodArticulo
+        WHERE mc.Gestion = k.cuenta_gestion
+          AND mc.NroInternacion = k.cuenta_internacion
+    ) AS ejecuciones_medicamentos,
+
+    -- ========================================================================
+    -- 5. NOTAS DE ENFERMERÍA
+    -- ========================================================================
+    (
+        SELECT GROUP_CONCAT(
+            CONCAT(
+                'Fecha: ', COALESCE(NotaEnfHoraRealizado, NotaEnfMFecha),
+                ' | Usuario: ', NotaEnfMUsuario,
+                ' | Nota: ', NotaEnfConclusion
+            )
+            ORDER BY COALESCE(NotaEnfHoraRealizado, NotaEnfMFecha) ASC
+            SEPARATOR '\n'
+        )
+        FROM notasenfermeria
+        WHERE PersonaNumero = k.persona_numero
+          AND InterGestion = k.cuenta_gestion
+          AND InterNroInternacion = k.cuenta_internacion
+          AND InterNroIntID = k.cuenta_id
+    ) AS notas_enfermeria,
+
+    -- ========================================================================
+    -- 6. RESULTADOS DE LABORATORIO
+    -- ========================================================================
+    (
+        SELECT GROUP_CONCAT(
+            DISTINCT CONCAT(
+                'Servicio: ', descripcion_servicio,
+                ' | Fecha: ', fecha_orden,
+                ' | Lab #', numero_laboratorio,
+                ' | Resultados: ', linea_detalle, ': ', resultado, ' ', COALESCE(unidad, ''),
+                ' (Ref: ', COALESCE(valor_referencia, 'N/A'), ')'
+            )
+            ORDER BY fecha_orden ASC, linea_detalle ASC
+            SEPARATOR '\n'
+        )
+        FROM vw_hc_resultados_laboratorio
+        WHERE persona_numero = k.persona_numero
+          AND cuenta_gestion = k.cuenta_gestion
+          AND cuenta_internacion = k.cuenta_internacion
+          AND cuenta_id = k.cuenta_id
+    ) AS laboratorios,
+
+    -- ========================================================================
+    -- 7. ESTUDIOS DE IMAGEN
+    -- ========================================================================
+    (
+        SELECT GROUP_CONCAT(
+            DISTINCT CONCAT(
+                'Tipo: ', enc.tipo_estudio,
+                ' | Fecha: ', enc.fecha_estudio,
+                ' | Solicitante: ', enc.medico_solicitante,
+                ' | Informante: ', enc.medico_informante,
+                ' | Título: ', det.titulo,
+                ' | Hallazgos: ', det.descripcion
+            )
+            ORDER BY enc.fecha_estudio ASC
+            SEPARATOR '\n---IMAGEN---\n'
+        )
+        FROM vw_hc_resultados_imagenes_encabezado enc
+        JOIN vw_hc_resultados_imagenes_detalle det
+            ON det.solicitud_codigo = enc.solicitud_codigo
+        WHERE enc.persona_numero = k.persona_numero
+          AND enc.cuenta_gestion = k.cuenta_gestion
+          AND enc.cuenta_internacion = k.cuenta_internacion
+          AND enc.cuenta_id = k.cuenta_id
+    ) AS estudios_imagen,
+
+    -- ========================================================================
+    -- 8. SOLICITUDES DE LABORATORIO (incluye pendientes sin resultado)
+    -- ========================================================================
+    -- Esta sección muestra TODOS los laboratorios solicitados, independientemente
+    -- de si ya tienen resultado o no. Complementa la sección 6 que solo muestra
+    -- laboratorios CON resultados.
+    -- ========================================================================
+    (
+        SELECT GROUP_CONCAT(
+            DISTINCT CONCAT(
+                'Estudio: ', prod.Descripcion,
+                ' | Fecha solicitud: ', maestro.PacienteSolicudLaboratorioSFec,
+                ' | Codigo: ', prod.CodProdCMF
+            )
+            ORDER BY maestro.PacienteSolicudLaboratorioSFec ASC
+            SEPARATOR '\n'
+        )
+        FROM pacientesolicudlaboratorio maestro
+        INNER JOIN pacientesolicudlaboratoriolabo det
+            ON det.PacienteSolicudLaboratorioCodi = maestro.PacienteSolicudLaboratorioCodi
+        INNER JOIN clinica01.productos prod
+            ON prod.CodProdCMF = det.productosCodProdCMF
+        WHERE maestro.PacienteLaboCodigo = k.persona_numero
+          AND maestro.PacienteSolicudLaboratorioGest = k.cuenta_gestion
+          AND maestro.PacienteSolicudLaboratorioNroI = k.cuenta_internacion
+    ) AS solicitudes_laboratorio,
+
+    -- ========================================================================
+    -- 9. SOLICITUDES DE IMAGEN/ESTUDIOS (incluye pendientes sin informe)
+    -- ========================================================================
+    -- Esta sección muestra TODOS los estudios de imagen solicitados,
+    -- independientemente de si ya tienen informe radiológico o no.
+    -- Complementa la sección 7 que solo muestra imágenes CON resultados.
+    -- FIX v1.2.0: Resuelve falsos negativos donde RX/TAC/ECO aparecían como
+    -- "no solicitados" cuando simplemente no tenían informe aún.
+    -- ========================================================================
+    (
+        SELECT GROUP_CONCAT(
+            DISTINCT CONCAT(
+                'Estudio: ', prest.PrestacionDescripcion,
+                ' | Fecha solicitud: ', sol.PacienteSolicudEstudioSFecha,
+                ' | Codigo: ', prest.PrestacionCodigo
+            )
+            ORDER BY sol.PacienteSolicudEstudioSFecha ASC
+            SEPARATOR '\n'
+        )
+        FROM pacientesolicudestudio sol
+        INNER JOIN prestacion prest
+            ON prest.PrestacionCodigo = sol.PrestacionCodigo
+        INNER JOIN turnoatencion ate
+            ON ate.TurnoNumero = sol.TurnoNumero
+        WHERE sol.Pacienteimagencodigo = k.persona_numero
+          AND ate.InternacionesGestion = k.cuenta_gestion
+          AND ate.InternacionesNroInternacion = k.cuenta_internacion
+          AND ate.InternacionesNroIntId = k.cuenta_id
+    ) AS solicitudes_imagen
+
+-- Claves de las atenciones solicitadas (una fila por cuenta)
+FROM (
+    SELECT DISTINCT
+        pe.PersonaNumero AS persona_numero,
+        pe.PacienteEvolucionGestion AS cuenta_gestion,
+        pe.PacienteEvolucionNroInter AS cuenta_internacion,
+        pe.PacienteEvolucionNroIntId AS cuenta_id
+    FROM pacienteevolucion pe
+    WHERE (pe.PersonaNumero, pe.PacienteEvolucionGestion, pe.PacienteEvolucionNroInter, pe.PacienteEvolucionNroIntId) IN %s
+) k;
\ No newline at end of file
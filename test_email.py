@@ -5,6 +5,19 @@ Ejecutar: python test_email.py
 
 import logging
 import sys
+import tempfile
+
+# HTML de prueba ya codificado: se escribe tal cual, sin capa de texto
+_HTML_PRUEBA = b"""<!DOCTYPE html>
+<html>
+<head><title>Test</title></head>
+<body>
+<h1>Correo de Prueba - Auditoria Urgencias</h1>
+<p>Este es un correo de prueba del sistema de auditoria.</p>
+<p>Si recibes este correo, el envio funciona correctamente.</p>
+</body>
+</html>
+"""
 
 # Configurar logging detallado
 logging.basicConfig(
@@ -54,30 +67,21 @@ try:
     print(f"\n2. Enviando correo de prueba a {len(destinatarios)} destinatario(s)...")
 
     # Crear un HTML de prueba simple
-    test_html = "test_email_temp.html"
-    with open(test_html, "w", encoding="utf-8") as f:
-        f.write("""
-<!DOCTYPE html>
-<html>
-<head><title>Test</title></head>
-<body>
-<h1>Correo de Prueba - Auditoria Urgencias</h1>
-<p>Este es un correo de prueba del sistema de auditoria.</p>
-<p>Si recibes este correo, el envio funciona correctamente.</p>
-</body>
-</html>
-        """)
-
-    # Enviar
-    resultado = sender.enviar_reporte_auditoria(
-        destinatarios=destinatarios,
-        html_path=test_html,
-        fecha_reporte="2025-12-01 (PRUEBA)"
-    )
-
-    # Limpiar archivo temporal
-    if os.path.exists(test_html):
-        os.remove(test_html)
+    with tempfile.NamedTemporaryFile('wb', prefix='test_email_', suffix='.html', delete=False) as tf:
+        tf.write(_HTML_PRUEBA)
+        test_html = tf.name
+
+    try:
+        # Enviar
+        resultado = sender.enviar_reporte_auditoria(
+            destinatarios=destinatarios,
+            html_path=test_html,
+            fecha_reporte="2025-12-01 (PRUEBA)"
+        )
+        sender.cerrar()
+    finally:
+        # Limpiar archivo temporal (tambien si el envio lanzo una excepcion)
+        os.unlink(test_html)
 
     print("\n" + "=" * 60)
     if resultado:
@@ -0,0 +1,36 @@
+"""
+Utilidades de archivos compartidas por main.py y minio_client.py
+"""
+
+import os
+from typing import Optional, Set
+
+
+def rutas_existentes(*rutas: Optional[str]) -> Set[str]:
+    """
+    Devuelve cuáles de las rutas existen como archivo
+
+    Hace un solo os.scandir por directorio en lugar de un stat por ruta (cada stat
+    es un roundtrip si output/ o logs/ están en un volumen de red).
+
+    Args:
+        rutas: Rutas a verificar (las None o vacías se ignoran)
+
+    Returns:
+        Conjunto con las rutas existentes, tal como se recibieron
+    """
+    por_directorio = {}
+    for ruta in rutas:
+        if ruta:
+            por_directorio.setdefault(os.path.dirname(ruta) or ".", []).append(ruta)
+
+    existentes = set()
+    for directorio, rutas_directorio in por_directorio.items():
+        try:
+            with os.scandir(directorio) as entradas:
+                nombres = {entrada.name for entrada in entradas if entrada.is_file()}
+        except OSError:
+            continue
+        existentes.update(ruta for ruta in rutas_directorio if os.path.basename(ruta) in nombres)
+
+    return existentes
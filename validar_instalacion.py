@@ -45,7 +45,9 @@ def main():
         "ver_historial_raw.py",
         "queries/get_todas_atenciones_24h.sql",
         "queries/get_detalle_atencion.sql",
+        "queries/get_detalles_atenciones.sql",
         "utils/__init__.py",
+        "utils/archivos.py",
         "pyproject.toml",
         "README.md",
         "CHANGELOG.md",